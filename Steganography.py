@@ -1,815 +1,1779 @@
 from pprint import pprint as pp
+import os
+import sys
+import time
+import glob
+import argparse
+import functools
+import operator
+import hashlib
+import json
+import tempfile
+import threading
 import numpy as np
 import zlib
-import base64
+import bz2
+import lzma
 import re
-from scipy.misc import imread
+import struct
+from collections import namedtuple, deque, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from scipy.misc import imread, imsave
+from SteganographyPng import readLeadingPixels, PngReader, PngWriter, UnsupportedPng
+
+
+# Hooks called with (name, start, duration, size, thread) whenever a span finishes; spans are only timed while
+# there is at least one
+_traceHooks = []
+
+
+def addTraceHook(hook):
+    _traceHooks.append(hook)
+
+
+def removeTraceHook(hook):
+    _traceHooks.remove(hook)
+
+
+class Span:
+    __slots__ = ("name", "size", "start")
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        duration = time.perf_counter() - self.start
+
+        for hook in list(_traceHooks):
+            hook(self.name, self.start, duration, self.size, threading.get_ident())
+
+
+class NullSpan:
+    # Shared by every span while nothing is tracing; sizes assigned to it are dropped
+    size = property(lambda self: 0, lambda self, value: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+_NULL_SPAN = NullSpan()
+
+
+def span(name, size=0):
+    # Times a stage (of size bytes, which may also be set on the span once known) for the trace hooks
+    return Span(name, size) if _traceHooks else _NULL_SPAN
+
+
+class Tracer:
+    # Collects the spans of everything run inside a with block (on any thread) for a Chrome trace or a summary
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name, start, duration, size, thread):
+        with self.lock:
+            self.spans.append((name, start, duration, int(size), thread))
+
+    def __enter__(self):
+        addTraceHook(self)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        removeTraceHook(self)
+
+    def chromeTrace(self):
+        # Complete ("X") events in microseconds, loadable in chrome://tracing and Perfetto
+        events = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": os.getpid(),
+                   "tid": thread, "args": {"bytes": size}} for (name, start, duration, size, thread) in self.spans]
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def saveChromeTrace(self, path):
+        with open(path, "w") as traceFile:
+            json.dump(self.chromeTrace(), traceFile)
+
+    def summary(self):
+        # One line per span name, slowest first
+        totals = OrderedDict()
+        for (name, start, duration, size, thread) in self.spans:
+            (calls, seconds, bytesSeen) = totals.get(name, (0, 0.0, 0))
+            totals[name] = (calls + 1, seconds + duration, bytesSeen + size)
+
+        lines = ["{:<24} {:>7} {:>10} {:>10} {:>10} {:>10}".format("span", "calls", "total s", "mean ms", "MB", "MB/s")]
+        for (name, (calls, seconds, bytesSeen)) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append("{:<24} {:>7} {:>10.4f} {:>10.3f} {:>10.2f} {:>10.1f}".format(
+                name, calls, seconds, seconds / calls * 1e3, bytesSeen / 1e6, bytesSeen / 1e6 / max(seconds, 1e-9)))
+
+        return "\n".join(lines)
+
+
+# The 64 characters of the radix 64 (base64) alphabet, indexed by their 6-bit value
+RADIX64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+# Precomputed lookup arrays between 6-bit values and base64 characters (ascii codes)
+_NUM_TO_CHAR = np.frombuffer(RADIX64_ALPHABET, dtype=np.uint8)
+_CHAR_TO_NUM = np.zeros(256, dtype=np.uint8)
+_CHAR_TO_NUM[_NUM_TO_CHAR] = np.arange(64, dtype=np.uint8)
+
+
+def encode6Bit(data):
+    # Pack a byte buffer into 6-bit symbols: every 3 bytes become 4 symbols, the last group is zero padded.
+    # The symbols are identical to the values of the base64 encoding of the data, without the '=' padding.
+    buf = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data.ravel()
+    buf = buf.astype(np.uint8, copy=False)
+    symCount = (buf.size * 4 + 2) // 3
+
+    if buf.size % 3:
+        buf = np.concatenate([buf, np.zeros(3 - buf.size % 3, dtype=np.uint8)])
+
+    triples = buf.reshape(-1, 3)
+    symbols = np.empty((triples.shape[0], 4), dtype=np.uint8)
+    symbols[:, 0] = triples[:, 0] >> 2
+    symbols[:, 1] = ((triples[:, 0] & 0x03) << 4) | (triples[:, 1] >> 4)
+    symbols[:, 2] = ((triples[:, 1] & 0x0F) << 2) | (triples[:, 2] >> 6)
+    symbols[:, 3] = triples[:, 2] & 0x3F
+
+    return symbols.reshape(-1)[:symCount]
+
+
+def decode6Bit(symbols):
+    # Unpack 6-bit symbols back into bytes: every 4 symbols become 3 bytes, trailing partial bits are dropped
+    sym = np.asarray(symbols).ravel().astype(np.uint8, copy=False)
+    byteCount = sym.size * 3 // 4
+
+    if sym.size % 4:
+        sym = np.concatenate([sym, np.zeros(4 - sym.size % 4, dtype=np.uint8)])
+
+    quads = sym.reshape(-1, 4)
+    data = np.empty((quads.shape[0], 3), dtype=np.uint8)
+    data[:, 0] = (quads[:, 0] << 2) | (quads[:, 1] >> 4)
+    data[:, 1] = ((quads[:, 1] & 0x0F) << 4) | (quads[:, 2] >> 2)
+    data[:, 2] = ((quads[:, 2] & 0x03) << 6) | (quads[:, 3] & 0x3F)
+
+    return data.reshape(-1)[:byteCount]
+
+
+def charsTo6Bit(chars):
+    # Map base64 characters (ascii codes) to their 6-bit values, dropping the '=' padding
+    buf = np.asarray(chars, dtype=np.uint8).ravel()
+    buf = buf[:buf.size - (buf[-2:] == 61).sum()] if buf.size else buf
+
+    return _CHAR_TO_NUM[buf]
+
+
+def sixBitToChars(symbols):
+    # Map 6-bit values to base64 characters, adding the '=' padding
+    sym = np.asarray(symbols).ravel().astype(np.uint8, copy=False)
+    padding = b"=" * ((-sym.size) % 4) if sym.size % 4 != 1 else b""
+
+    return _NUM_TO_CHAR[sym & 0x3F].tobytes() + padding
+
+
+# Version 2 payloads are a binary container instead of the XML string: a fixed little-endian header followed by
+# the raw or compressed raster scan. The header is 27 bytes, so the body starts on a symbol boundary (symbol 36).
+PAYLOAD_MAGIC = b"STEG"
+PAYLOAD_HEADER = struct.Struct("<4sBBBBBbBIIQ")
+PayloadHeader = namedtuple("PayloadHeader", ["magic", "version", "type", "channels", "dtype", "codec", "level",
+                                             "bitsPerChannel", "rows", "cols", "length"])
+
+PAYLOAD_TYPES = ["Gray", "Color"]
+PAYLOAD_DTYPES = [np.dtype("uint8"), np.dtype("<u2")]
+
+
+# Compression codecs by name. compress(data, level) returns bytes; decompressobj() returns a streaming
+# decompressor with decompress(data) and, optionally, flush(); compressobj(level) returns a streaming
+# compressor with compress(data) and flush(). The id is what binary payloads record.
+Codec = namedtuple("Codec", ["id", "name", "compress", "decompressobj", "compressobj"])
+CODECS = OrderedDict()
+
+
+def registerCodec(codecId, name, compress, decompressobj, compressobj):
+    if any(codec.id == codecId for codec in CODECS.values() if codec.name != name):
+        raise ValueError("Codec id %d is already registered." % codecId)
+
+    CODECS[name] = Codec(codecId, name, compress, decompressobj, compressobj)
+
+
+def getCodec(key):
+    # Looks a codec up by name or by id
+    for codec in CODECS.values():
+        if key == codec.name or key == codec.id:
+            return codec
+
+    raise ValueError("Unknown compression codec %r." % (key,))
+
+
+class NullCompressor:
+    def __init__(self, level=-1):
+        pass
+
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+registerCodec(0, "none", lambda data, level: bytes(data), NullCompressor, NullCompressor)
+registerCodec(1, "zlib", lambda data, level: zlib.compress(data, level), zlib.decompressobj, zlib.compressobj)
+registerCodec(2, "bz2", lambda data, level: bz2.compress(data, max(level, 1)), bz2.BZ2Decompressor,
+              lambda level: bz2.BZ2Compressor(max(level, 1)))
+registerCodec(3, "lzma", lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor,
+              lambda level: lzma.LZMACompressor(preset=level))
+
+
+# Block-parallel deflate (pigz style): the data is cut into BLOCK_SIZE blocks that are deflated independently
+# on a thread pool (zlib releases the GIL). Every block is framed by its compressed length (uint32, little-endian)
+# so the block boundaries are known without inflating, and the blocks can be inflated in parallel as well.
+BLOCK_SIZE = 1 << 20
+BLOCK_FRAME = struct.Struct("<I")
+
+
+def blockCompress(data, level, blockSize=None, workers=None):
+    compressor = BlockCompressor(level, blockSize, workers)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def blockDecompress(data, workers=None):
+    decompressor = BlockDecompressor(workers)
+
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class BlockCompressor:
+    def __init__(self, level=-1, blockSize=None, workers=None):
+        self.level = level
+        self.blockSize = blockSize or BLOCK_SIZE
+        self.workers = workers or os.cpu_count() or 1
+        self.pending = bytearray()
+
+    def compress(self, data):
+        # Deflates as many complete batches of blocks (one block per worker) as are buffered
+        self.pending += memoryview(data).cast("B")
+        batch = self.blockSize * self.workers
+
+        if len(self.pending) < batch:
+            return b""
+
+        usable = len(self.pending) // batch * batch
+        output = self.deflate(memoryview(self.pending)[:usable])
+        del self.pending[:usable]
+
+        return output
+
+    def flush(self):
+        output = self.deflate(memoryview(self.pending))
+        self.pending = bytearray()
+
+        return output
+
+    def deflate(self, data):
+        blocks = [bytes(data[start:start + self.blockSize]) for start in range(0, len(data), self.blockSize)]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            frames = pool.map(lambda block: zlib.compress(block, self.level), blocks)
+
+        return b"".join(BLOCK_FRAME.pack(len(frame)) + frame for frame in frames)
+
+
+class BlockDecompressor:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pending = bytearray()
+
+    def complete(self):
+        # Returns the (start, stop) of every block that has fully arrived
+        (blocks, pos) = ([], 0)
+
+        while pos + BLOCK_FRAME.size <= len(self.pending):
+            (length, ) = BLOCK_FRAME.unpack_from(self.pending, pos)
+            if pos + BLOCK_FRAME.size + length > len(self.pending):
+                break
+
+            blocks.append((pos + BLOCK_FRAME.size, pos + BLOCK_FRAME.size + length))
+            pos += BLOCK_FRAME.size + length
+
+        return blocks, pos
+
+    def decompress(self, data, final=False):
+        # Inflates the complete blocks once there is at least one per worker (or when flushing)
+        self.pending += memoryview(data).cast("B")
+        (blocks, used) = self.complete()
+
+        if not blocks or (len(blocks) < self.workers and not final):
+            return b""
+
+        view = memoryview(self.pending)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            output = b"".join(pool.map(lambda block: zlib.decompress(view[block[0]:block[1]]), blocks))
+
+        view.release()
+        del self.pending[:used]
+
+        return output
+
+    def flush(self):
+        output = self.decompress(b"", final=True)
+
+        if self.pending:
+            raise ValueError("The block compressed data is truncated.")
+
+        return output
+
+
+registerCodec(4, "pzlib", blockCompress, BlockDecompressor, BlockCompressor)
+
+# (codec, compressionLevel) for common speed / ratio trade-offs
+CODEC_PROFILES = {"fastest": ("zlib", 1), "balanced": ("zlib", 6), "parallel": ("pzlib", 6), "small": ("bz2", 9),
+                  "archival": ("lzma", 9)}
+
+
+def rasterScan(img):
+    # Scan each channel independently (all red, then all green, then all blue) into one contiguous array
+    if img.ndim == 3:
+        return np.ascontiguousarray(img.transpose(2, 0, 1)).reshape(-1)
+
+    return np.ascontiguousarray(img).reshape(-1)
+
+
+def xmlPlanes(img):
+    # XML payloads carry the gray plane or the red, green and blue planes; any further (alpha) channel is dropped
+    if img.ndim == 3 and img.shape[2] < 3:
+        raise ValueError("Color payloads need red, green and blue channels.")
+
+    return img[:, :, :3] if img.ndim == 3 else img
+
+
+def rasterChunks(img, chunkSize=1 << 20):
+    # Yields the raster scan (as little-endian bytes) in blocks of rows of about chunkSize bytes, channel by channel
+    planes = [img[:, :, ch] for ch in range(img.shape[2])] if img.ndim == 3 else [img]
+    rowsPerChunk = max(1, chunkSize // max(1, img.shape[1] * img.itemsize))
+
+    for plane in planes:
+        for row in range(0, plane.shape[0], rowsPerChunk):
+            block = np.ascontiguousarray(plane[row:row + rowsPerChunk], dtype=img.dtype.newbyteorder("<"))
+            yield block.reshape(-1).view(np.uint8)
+
+
+def compressChunks(chunks, codec, compressionLevel):
+    # Feeds byte chunks through a streaming compressor, yielding whatever output it produces
+    if codec.name == "none":
+        yield from chunks
+        return
+
+    compressor = codec.compressobj(compressionLevel)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield np.frombuffer(data, dtype=np.uint8)
+
+    yield np.frombuffer(compressor.flush(), dtype=np.uint8)
+
+
+def packLsb(carry, chunk, bitsPerChannel=2):
+    # Spreads the carried over bytes and the chunk over carrier values, carrying the bytes that do not fill a
+    # whole 9 byte unit (72 bits divide evenly into groups of 3 values at every depth)
+    data = np.concatenate([carry, chunk]) if carry.size else chunk
+    usable = data.size // 9 * 9
+
+    return bytesToLsb(data[:usable], bitsPerChannel), data[usable:].copy()
+
+
+# Carrier values holding the binary header, which is always embedded with 2 bits per channel
+HEADER_SAMPLES = PAYLOAD_HEADER.size * 4
+
+
+def bytesToLsb(data, bitsPerChannel):
+    # Spreads bytes over carrier values, bitsPerChannel bits per value. Every 3 values hold 3 * bitsPerChannel bits
+    # of the stream (most significant first), and the first value takes the least significant part of the group,
+    # so 2 bits per channel gives exactly the 6-bit symbol layout.
+    bits = np.unpackbits(np.asarray(data, dtype=np.uint8).reshape(-1))
+    group = 3 * bitsPerChannel
+
+    if bits.size % group:
+        bits = np.concatenate([bits, np.zeros(group - bits.size % group, dtype=np.uint8)])
+
+    parts = bits.reshape(-1, 3, bitsPerChannel)[:, ::-1, :].reshape(-1, bitsPerChannel)
+
+    return np.packbits(parts, axis=1).reshape(-1) >> np.uint8(8 - bitsPerChannel)
+
+
+def lsbToBytes(values, bitsPerChannel, byteCount):
+    # Inverse of bytesToLsb(): gathers the bitsPerChannel LSBs of every value back into byteCount bytes
+    values = np.asarray(values, dtype=np.uint8).reshape(-1, 3)
+    parts = np.unpackbits(values[:, ::-1, np.newaxis], axis=2)[:, :, 8 - bitsPerChannel:]
+
+    return np.packbits(parts.reshape(-1))[:byteCount]
+
+
+def payloadSegments(payload, bitsPerChannel=2):
+    # The (first carrier value, values, bits per channel) runs that embed the payload. Binary payloads embedded
+    # with another depth keep their header at 2 bits per channel, recording the depth of the body that follows.
+    if bitsPerChannel not in (1, 2, 3, 4):
+        raise ValueError("bitsPerChannel must be between 1 and 4, inclusive.")
+
+    if bitsPerChannel == 2:
+        content = np.asarray(payload.content, dtype=np.uint8)
+        values = (content[:, np.newaxis] >> np.array([0, 2, 4], dtype=np.uint8)) & np.uint8(3)
+        return [(0, values.reshape(-1), 2)]
+
+    if payload.version != 2:
+        raise ValueError("Only binary (version 2) payloads can be embedded with other than 2 bits per channel.")
+
+    data = decode6Bit(payload.content)
+    header = parsePayloadHeader(data)._replace(bitsPerChannel=bitsPerChannel)
+    head = bytesToLsb(np.frombuffer(PAYLOAD_HEADER.pack(*header), dtype=np.uint8), 2)
+
+    return [(0, head, 2), (HEADER_SAMPLES, bytesToLsb(data[PAYLOAD_HEADER.size:], bitsPerChannel), bitsPerChannel)]
+
+
+def randomizeLsb(values, rng, bitsPerChannel=2):
+    # XORs the bitsPerChannel LSBs of values (in place) with random bits. The bits are drawn packed, a random byte
+    # covering 8 // bitsPerChannel values, and XORed into every lane of values without expanding them.
+    lanes = 8 // bitsPerChannel
+    random = np.frombuffer(rng.bytes(-(-values.size // lanes)), dtype=np.uint8)
+    mask = np.uint8((1 << bitsPerChannel) - 1)
+
+    for lane in range(lanes):
+        target = values[lane::lanes]
+        target ^= (random[:target.size] >> np.uint8(lane * bitsPerChannel)) & mask
+
+
+def lsbSampleCount(byteCount, bitsPerChannel):
+    # Number of carrier values needed for byteCount bytes (always a multiple of 3)
+    groups = -(-byteCount * 8 // (3 * bitsPerChannel))
+
+    return groups * 3
+
+
+def parsePayloadHeader(data):
+    # Returns the PayloadHeader of a version 2 payload, or None when the data does not start with one
+    data = np.asarray(data, dtype=np.uint8)
+
+    if data.size < PAYLOAD_HEADER.size or data[:len(PAYLOAD_MAGIC)].tobytes() != PAYLOAD_MAGIC:
+        return None
+
+    header = PayloadHeader._make(PAYLOAD_HEADER.unpack(data[:PAYLOAD_HEADER.size].tobytes()))
+
+    if header.version != 2:
+        raise ValueError("Unsupported payload version %d." % header.version)
+
+    if not 1 <= header.bitsPerChannel <= 4:
+        raise ValueError("Unsupported number of bits per channel %d." % header.bitsPerChannel)
+
+    return header
+
+
+# Number of leading bytes searched for the <payload ...> tag of an XML payload
+XML_HEADER_SCAN = 512
+
+
+def parseXmlHeader(head):
+    # Reads the attributes of the <payload ...> tag; returns them with the offset where the body starts
+    tag = re.search(rb"<payload ([^>]*)>", head)
+
+    if tag is None:
+        raise ValueError("The payload header could not be found.")
+
+    attributes = {key.decode(): value.decode() for (key, value) in re.findall(rb'(\w+)="([^"]*)"', tag.group(1))}
+
+    return attributes, tag.end()
+
+
+def xmlPayloadHead(payloadType, rows, cols, compressed, codec="zlib"):
+    # The XML declaration and <payload> tag; the codec is only written when it is not the default zlib
+    head = '<?xml version="1.0" encoding="UTF-8"?><payload type="%s" size="%d,%d" compressed="%s"' % (
+        payloadType, rows, cols, compressed)
+
+    if compressed and codec != "zlib":
+        head += ' codec="%s"' % codec
+
+    return head + ">"
+
+
+# Decimal text of every byte value followed by a comma, padded to 4 characters, and the used length of each
+_CSV_TEXT = np.frombuffer(b"".join(("%d," % value).ljust(4).encode() for value in range(256)),
+                          dtype=np.uint8).reshape(256, 4)
+_CSV_LENGTHS = np.array([len("%d," % value) for value in range(256)], dtype=np.uint8)
+
+
+def formatCsvBody(values):
+    # Writes byte values as comma separated decimal text without building Python objects
+    values = np.asarray(values, dtype=np.uint8).reshape(-1)
+
+    if values.size == 0:
+        return b""
+
+    used = np.arange(4, dtype=np.uint8) < _CSV_LENGTHS[values][:, np.newaxis]
+
+    # Drop the comma after the last value
+    return _CSV_TEXT[values][used][:-1].tobytes()
+
+
+def parseCsvBody(body):
+    # Parses comma separated decimal values (0 - 255) into a uint8 array without building Python objects
+    body = np.asarray(body, dtype=np.uint8)
+
+    if body.size == 0:
+        return np.empty(0, dtype=np.uint8)
+
+    separators = np.flatnonzero(body == ord(","))
+    ends = np.append(separators, body.size)
+    lengths = ends - np.insert(separators + 1, 0, 0)
+
+    digits = body - np.uint8(ord("0"))
+    digits[separators] = 0
+
+    if lengths.min() < 1 or lengths.max() > 3 or digits.max() > 9:
+        raise ValueError("The payload body is not a list of bytes.")
+
+    # Every value has up to 3 digits, add the tens and hundreds where the value is long enough
+    values = digits[ends - 1].astype(np.uint16)
+    values[lengths >= 2] += 10 * digits[ends[lengths >= 2] - 2]
+    values[lengths == 3] += 100 * digits[ends[lengths == 3] - 3].astype(np.uint16)
+
+    if values.max() > 255:
+        raise ValueError("The payload body is not a list of bytes.")
+
+    return values.astype(np.uint8)
+
+
+def inflateInto(data, out, codec="zlib", chunkSize=1 << 20):
+    # Decompresses data chunk by chunk straight into the preallocated out buffer
+    decompressor = getCodec(codec).decompressobj()
+    pos = 0
+
+    for start in range(0, data.size, chunkSize):
+        chunk = decompressor.decompress(data[start:start + chunkSize])
+
+        if pos + len(chunk) > out.size:
+            raise ValueError("The payload body is larger than its declared size.")
+
+        out[pos:pos + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        pos += len(chunk)
+
+    chunk = decompressor.flush() if hasattr(decompressor, "flush") else b""
+    if pos + len(chunk) != out.size:
+        raise ValueError("The payload body does not match its declared size.")
+
+    out[pos:] = np.frombuffer(chunk, dtype=np.uint8)
+
+    return out
+
+
+def isPayloadPrefix(prefix):
+    # Checks the first 5 decoded bytes of a carrier for either payload format
+    return prefix == b'<?xml' or prefix == PAYLOAD_MAGIC + bytes([2])
 
 
 class Payload:
-    def __init__(self, img=None, compressionLevel=-1, content=None):
+    def __init__(self, img=None, compressionLevel=-1, content=None, version=1, codec="zlib"):
         if compressionLevel < -1 or compressionLevel > 9:
             raise ValueError("compressionLevel must be between -1 and 9, inclusive.")
 
+        if version not in (1, 2):
+            raise ValueError("version must be 1 (XML) or 2 (binary).")
+
         if img is None and content is None:
             raise ValueError("The content or image must be provided.")
 
         if type(content) != np.ndarray and type(img) != np.ndarray:
             raise TypeError("content and img must be of type numpy.ndarray")
 
+        self.version = version
+        self.codec = getCodec(codec).name
+
         if img is None:
             self.content = content
-            self.img = self.reconstructPayloadImage(content)
+            with span("Payload.reconstruct", content.size):
+                self.img = self.reconstructPayloadImage(content)
         elif content is None:
             self.img = img
-            self.content = self.generateContentArray(compressionLevel)
+            with span("Payload.generate", img.nbytes):
+                self.content = self.generateContentArray(compressionLevel)
+        else:
+            # Both are known already (e.g. from a PayloadCache), nothing to compute
+            self.img = img
+            self.content = content
 
     def generateContentArray(self, compressionLevel):
-        xmlString = '<?xml version="1.0" encoding="UTF-8"?>'
-
-        if self.img.ndim == 3:
-            payloadType = "Color"
-            (row, col, ch) = self.img.shape
-            size = "%d,%d" % (row, col)
+        if self.version == 2:
+            return self.generateBinaryContent(compressionLevel)
 
-            # Extract the red, green and blue pixels --> reshape() can also be used. Need to check complexity
-            fullImg = np.concatenate([self.img[:, :, 0].flat, self.img[:, :, 1].flat, self.img[:, :, 2].flat])
+        payloadType = "Color" if self.img.ndim == 3 else "Gray"
+        (row, col) = self.img.shape[:2]
 
-            # Compress the image given the compression level; ignore if -1
-            if compressionLevel != -1:
-                compress = "True"
-                xmlString += '<payload type="%s" size="%s" compressed="%s">' % (payloadType, size, compress)
+        # Scan the red, green and blue pixels one channel after the other
+        with span("rasterScan", self.img.nbytes):
+            fullImg = rasterScan(xmlPlanes(self.img))
 
-                # Compress the data with the relevant compression level
-                compressData = zlib.compress(bytearray(fullImg), compressionLevel)
+        # Compress the image given the compression level; ignore if -1
+        if compressionLevel != -1:
+            with span("compress", fullImg.nbytes):
+                body = getCodec(self.codec).compress(fullImg, compressionLevel)
+        else:
+            body = fullImg
 
-                # Add the compressed payload data to the XmlString
-                xmlString += ",".join(map(str, list(compressData)))
+        # Add the payload data between the header and the ending part of the xmlString
+        with span("formatCsvBody", len(body)):
+            head = xmlPayloadHead(payloadType, row, col, compressionLevel != -1, self.codec)
+            xmlString = head.encode('utf-8') + formatCsvBody(np.frombuffer(body, dtype=np.uint8)) + b"</payload>"
 
-            else:
-                compress = False
-                xmlString += '<payload type="{payLoad}" size="{rowCol}" compressed="{comp}">'.format(
-                    payLoad=payloadType, rowCol=size, comp=compress)
+        # Pack the xmlString into 6-bit symbols (the values of its base64 encoding)
+        with span("encode6Bit", len(xmlString)):
+            content = encode6Bit(xmlString)
 
-                # Add the payload data to the XmlString
-                xmlString += ",".join(map(str, list(fullImg)))
+        return content
 
-        elif self.img.ndim == 2:
-            payloadType = "Gray"
-            (row, col) = self.img.shape
-            size = "{r},{c}".format(r=row, c=col)
+    def generateBinaryContent(self, compressionLevel):
+        if self.img.dtype not in PAYLOAD_DTYPES:
+            raise TypeError("The payload image must be of type uint8 or uint16.")
 
-            # Extract the red, green and blue pixels --> reshape() can also be used. Need to check complexity
-            fullImg = list(self.img.flatten())
+        (row, col) = self.img.shape[:2]
+        channels = self.img.shape[2] if self.img.ndim == 3 else 1
+        payloadType = PAYLOAD_TYPES.index("Color" if self.img.ndim == 3 else "Gray")
 
-            if compressionLevel != -1:
-                compress = True
-                xmlString += '<payload type="{payLoad}" size="{rowCol}" compressed="{comp}">'.format(
-                    payLoad=payloadType, rowCol=size, comp=compress)
+        with span("rasterScan", self.img.nbytes):
+            fullImg = rasterScan(self.img).astype(self.img.dtype.newbyteorder("<"), copy=False).view(np.uint8)
 
-                # Compress the data with the relevant compression level
-                compressData = zlib.compress(bytearray(fullImg), compressionLevel)
+        # Compress the raster scan given the compression level; ignore if -1
+        codec = getCodec(self.codec if compressionLevel != -1 else "none")
+        if compressionLevel != -1:
+            with span("compress", fullImg.nbytes):
+                body = np.frombuffer(codec.compress(fullImg, compressionLevel), dtype=np.uint8)
+        else:
+            body = fullImg
 
-                # Add the compressed payload data to the XmlString
-                xmlString += ",".join(map(str, list(compressData)))
+        header = PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, 2, payloadType, channels, PAYLOAD_DTYPES.index(self.img.dtype),
+                                     codec.id, compressionLevel, 2, row, col, body.size)
 
-            else:
-                compress = False
-                xmlString += '<payload type="{payLoad}" size="{rowCol}" compressed="{comp}">'.format(
-                    payLoad=payloadType, rowCol=size, comp=compress)
+        with span("encode6Bit", PAYLOAD_HEADER.size + body.size):
+            return encode6Bit(np.concatenate([np.frombuffer(header, dtype=np.uint8), body]))
 
-                # Add the payload data to the XmlString
-                xmlString += ",".join(map(str, list(fullImg)))
+    def reconstructBinaryImage(self, data, header):
+        body = data[PAYLOAD_HEADER.size:PAYLOAD_HEADER.size + header.length]
 
-        # Add ending part to finish the xmlString
-        xmlString += "</payload>"
+        if body.size != header.length:
+            raise ValueError("The payload body is truncated.")
 
-        # Covert xmlString to base64 encoded data
-        encoded = base64.b64encode(xmlString.encode('utf-8'))
+        self.codec = getCodec(header.codec).name
+        if self.codec != "none":
+            size = header.rows * header.cols * header.channels * PAYLOAD_DTYPES[header.dtype].itemsize
+            with span("inflate", body.size):
+                body = inflateInto(body, np.empty(size, dtype=np.uint8), self.codec)
 
-        l = self.get6BitSeq(list(encoded))
-        # print(l)
+        fullImg = body.view(PAYLOAD_DTYPES[header.dtype])
 
-        # Convert the list to np.array() type
-        content = np.array(l, dtype=np.uint8)
+        if PAYLOAD_TYPES[header.type] == "Color":
+            img = fullImg.reshape(header.channels, header.rows, header.cols).transpose(1, 2, 0)
+        else:
+            img = fullImg.reshape(header.rows, header.cols)
 
-        return content
+        return np.ascontiguousarray(img, dtype=PAYLOAD_DTYPES[header.dtype].newbyteorder("="))
 
     def get6BitSeq(self, l):
-        table = self.charToNumTable()
-        l_ret = []
-
-        if l[-1] == 61 and l[-2] == 61:
-            l = l[:-2]
-        elif l[-1] == 61:
-            l = l[:-1]
-
-        a = np.array(l)
-
-        l_map = np.vectorize(table.get)(a)
-        #print(list(l_map))
-
-        return list(l_map)
+        # Map base64 characters (ascii codes) to their 6-bit values, dropping the padding
+        return charsTo6Bit(l)
 
     def get8bitSeq(self, l):
-        inv_map = self.numtoCharTable()
-        a = np.array(l)
-
-        l_map = np.vectorize(inv_map.get)(a)
-        l_map = l_map.flat
-        ret_str = "".join(map(str, list(l_map)))
-
-        if (len(l) * 3 % 4) == 2:
-            ret_str += "=="
-        elif (len(l) * 3 % 4) == 1:
-            ret_str += "="
-
-        ret_str = bytes(ret_str, 'utf-8')
-
-        return ret_str
+        # Map 6-bit values back to base64 characters, adding the padding
+        return sixBitToChars(l)
 
     def charToNumTable(self):
-        d = {43: 62,
-             47: 63,
-             48: 52,
-             49: 53,
-             50: 54,
-             51: 55,
-             52: 56,
-             53: 57,
-             54: 58,
-             55: 59,
-             56: 60,
-             57: 61,
-             65: 0,
-             66: 1,
-             67: 2,
-             68: 3,
-             69: 4,
-             70: 5,
-             71: 6,
-             72: 7,
-             73: 8,
-             74: 9,
-             75: 10,
-             76: 11,
-             77: 12,
-             78: 13,
-             79: 14,
-             80: 15,
-             81: 16,
-             82: 17,
-             83: 18,
-             84: 19,
-             85: 20,
-             86: 21,
-             87: 22,
-             88: 23,
-             89: 24,
-             90: 25,
-             97: 26,
-             98: 27,
-             99: 28,
-             100: 29,
-             101: 30,
-             102: 31,
-             103: 32,
-             104: 33,
-             105: 34,
-             106: 35,
-             107: 36,
-             108: 37,
-             109: 38,
-             110: 39,
-             111: 40,
-             112: 41,
-             113: 42,
-             114: 43,
-             115: 44,
-             116: 45,
-             117: 46,
-             118: 47,
-             119: 48,
-             120: 49,
-             121: 50,
-             122: 51
-             }
-
-        return d
+        return {c: i for (i, c) in enumerate(RADIX64_ALPHABET)}
 
     def numtoCharTable(self):
-        d = {0: 'A',
-             1: 'B',
-             2: 'C',
-             3: 'D',
-             4: 'E',
-             5: 'F',
-             6: 'G',
-             7: 'H',
-             8: 'I',
-             9: 'J',
-             10: 'K',
-             11: 'L',
-             12: 'M',
-             13: 'N',
-             14: 'O',
-             15: 'P',
-             16: 'Q',
-             17: 'R',
-             18: 'S',
-             19: 'T',
-             20: 'U',
-             21: 'V',
-             22: 'W',
-             23: 'X',
-             24: 'Y',
-             25: 'Z',
-             26: 'a',
-             27: 'b',
-             28: 'c',
-             29: 'd',
-             30: 'e',
-             31: 'f',
-             32: 'g',
-             33: 'h',
-             34: 'i',
-             35: 'j',
-             36: 'k',
-             37: 'l',
-             38: 'm',
-             39: 'n',
-             40: 'o',
-             41: 'p',
-             42: 'q',
-             43: 'r',
-             44: 's',
-             45: 't',
-             46: 'u',
-             47: 'v',
-             48: 'w',
-             49: 'x',
-             50: 'y',
-             51: 'z',
-             52: '0',
-             53: '1',
-             54: '2',
-             55: '3',
-             56: '4',
-             57: '5',
-             58: '6',
-             59: '7',
-             60: '8',
-             61: '9',
-             62: '+',
-             63: '/'
-             }
-
-        return d
+        return {i: chr(c) for (i, c) in enumerate(RADIX64_ALPHABET)}
 
     def reconstructPayloadImage(self, content):
         # Convert the radix 64 list into utf-8 list
-        encoded = self.get8bitSeq(content)
+        with span("decode6Bit", content.size):
+            data = decode6Bit(content)
 
-        xmlString = base64.b64decode(encoded)
+        return self.reconstructImage(data)
 
-        l = xmlString.split(b'</payload>')
-        xmlString = str(l[0] + b'</payload>')
+    def reconstructImage(self, data):
+        # Binary (version 2) payloads carry their own header
+        header = parsePayloadHeader(data)
+        if header is not None:
+            self.version = 2
+            return self.reconstructBinaryImage(data, header)
 
-        # Convert the utf-8 list into xmlString
-        # xmlString = str(base64.b64decode(encoded), 'utf-8')
-        # print(xmlString)
+        # Extract relevant information from the header of the xmlString
+        (attributes, bodyStart) = parseXmlHeader(data[:XML_HEADER_SCAN].tobytes())
 
-        #Get rid of the extra stuff
+        imgType = attributes["type"]
+        (row, col) = map(int, attributes["size"].split(","))
+        compress = attributes["compressed"]
+        self.codec = getCodec(attributes.get("codec", "zlib")).name
 
-        # Extract relevant information from the xmlString
-        pattern = r"type=\"([a-zA-Z]+)\" size=\"([0-9]+),([0-9]+)\" compressed=\"([a-zA-Z]+)\">(.*)<"
-        vals = re.search(pattern, xmlString)
+        # The body only holds digits and commas, so the first '<' is the start of '</payload>'
+        body = data[bodyStart:]
+        ends = np.flatnonzero(body == ord("<"))
+        if ends.size == 0:
+            raise ValueError("The payload is missing its closing tag.")
 
-        if vals:
-            imgType = str(vals.group(1))
-            row = int(vals.group(2))
-            col = int(vals.group(3))
-            compress = str(vals.group(4))
-            imgData = list(map(int, str(vals.group(5)).split(",")))
+        with span("parseCsvBody", ends[0]):
+            imgData = parseCsvBody(body[:ends[0]])
 
         # If it is a color image set the dimension number to 3
-        if (imgType == "Color"):
-            dimn = 3
-
-            # Check if the image data was compressed or not
-            if compress == "True":
-                fullImg = list(zlib.decompress(bytearray(imgData)))
-            elif compress == "False":
-                fullImg = imgData
-
-            # l = self.completeArray(fullImg)
-            # img = (np.array(l, dtype='uint8').reshape(row, col, dimn))
-
-            img = self.completeArray(fullImg)
-            img = np.reshape(img, (row, col, dimn))
+        dimn = 3 if imgType == "Color" else 1
 
+        # Check if the image data was compressed or not
+        if compress == "True":
+            with span("inflate", imgData.size):
+                fullImg = inflateInto(imgData, np.empty(row * col * dimn, dtype=np.uint8), self.codec)
+        elif compress == "False":
+            fullImg = imgData
 
+        if imgType == "Color":
+            img = np.ascontiguousarray(fullImg.reshape(dimn, row, col).transpose(1, 2, 0))
         elif imgType == "Gray":
-            # Check if the image data was compressed or not
-            if compress == "True":
-                fullImg = list(zlib.decompress(bytearray(imgData)))
-            elif compress == "False":
-                fullImg = imgData
-
-            img = (np.array(list(fullImg), dtype='uint8').reshape(row, col))
+            img = fullImg.reshape(row, col)
 
         return img
 
-    def completeArray(self, rgbImg):
-        # fullImg = len(rgbImg) * [0]
-        # fullImg[::3] = rgbImg[:int(len(rgbImg) / 3)]
-        # fullImg[1::3] = rgbImg[int(len(rgbImg) / 3):int(len(rgbImg) * 2 / 3)]
-        # fullImg[2::3] = rgbImg[int(len(rgbImg) * 2 / 3):]
-
-        # return list(fullImg)
-
-        rgbImg = np.array(rgbImg)
-        allVals = np.split(rgbImg, 3)
-
-        verticalVals = np.vstack([allVals[0], allVals[1], allVals[2]])
-        fullImg = np.transpose(verticalVals)
-        fullImg = np.uint8(fullImg)
-
-        return fullImg
 
 class Carrier:
     def __init__(self, img):
-        if type(img) != np.ndarray:
+        if not isinstance(img, np.ndarray):
             raise TypeError("Image being passed in must be of type np.ndarray")
 
         self.img = img
 
-    def payloadExists(self):
+    @classmethod
+    def fromMemmap(cls, path, shape=None, dtype=np.uint8, mode="r+"):
+        # Map a raw or .npy carrier from disk; only the pages that are read or written are faulted in
+        if path.endswith(".npy"):
+            img = np.load(path, mmap_mode=mode)
+        elif shape is None:
+            raise ValueError("The shape must be provided for raw carrier files.")
+        else:
+            img = np.memmap(path, dtype=dtype, mode=mode, shape=shape)
 
-        if self.img.ndim == 3:
-            header = self.img[0][:7]
-            headerList = list(((header & 0b11) << np.array([0, 2, 4])).sum(axis=1))
-            headerStr = self.get8bitSeq(headerList)
-            headerStr = base64.b64decode(headerStr)
+        return cls(img)
 
-        elif self.img.ndim == 2:
-            header = self.img[0][:21]
-            list2d = np.array(list(zip(header[::3], header[1::3], header[2::3])))
-            headerList = list(((list2d & 0b11) << np.array([0, 2, 4])).sum(axis=1))
-            headerStr = self.get8bitSeq(headerList)
-            headerStr = base64.b64decode(headerStr)
+    def flush(self):
+        # Write pending changes of a memory-mapped carrier back to disk
+        if isinstance(self.img, np.memmap):
+            self.img.flush()
 
+    def payloadExists(self):
+        # The first 7 symbols are read in embedding order, so gray carriers (and ones narrower than the prefix) go
+        # through the same strided kernel as color ones. Carriers too small for the prefix cannot hold a payload.
+        if self.img.size < 21:
+            return False
 
+        headerStr = decode6Bit(self.readSymbols(0, 7)).tobytes()
 
-        if headerStr == b'<?xml':
+        if isPayloadPrefix(headerStr):
             return True
 
         return False
 
-    def clean(self):
-        randVals = np.random.randint(0, 4, self.img.shape)
-        imgCpy = self.img ^ randVals
+    def clean(self, inplace=False, chunkSize=1 << 22, region="all", seed=None, workers=None, bitsPerChannel=2):
+        # Randomize the LSBs tile by tile, so that memory-mapped carriers are streamed through. region="payload" only
+        # touches the values that hold the payload (with the depth they were embedded with). Every tile draws from
+        # its own generator spawned from seed, so a seeded clean does not depend on the number of workers.
+        if region not in ("all", "payload"):
+            raise ValueError('region must be "all" or "payload".')
+
+        with span("Carrier.clean", self.img.size):
+            # The values are cleaned in the carrier's row-major order; reshape(-1) copies non-contiguous carriers
+            src = self.img.reshape(-1)
+            dst = src if inplace else np.empty(src.size, dtype=np.uint8)
+
+            runs = [(0, src.size, bitsPerChannel)] if region == "all" else self.payloadRuns()
+            tiles = range(0, src.size, chunkSize)
+            seeds = np.random.SeedSequence(seed).spawn(len(tiles))
+
+            def cleanTile(start, seedSequence):
+                stop = min(start + chunkSize, src.size)
+                if dst is not src:
+                    dst[start:stop] = src[start:stop]
+
+                rng = np.random.default_rng(seedSequence)
+                for (first, last, depth) in runs:
+                    if max(first, start) < min(last, stop):
+                        randomizeLsb(dst[max(first, start):min(last, stop)], rng, depth)
+
+            workers = min(workers or os.cpu_count() or 1, len(tiles))
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    list(pool.map(cleanTile, tiles, seeds))
+            else:
+                list(map(cleanTile, tiles, seeds))
+
+            if inplace:
+                # A non-contiguous carrier (e.g. a sliced view) was cleaned in a copy, which is written back
+                if not np.may_share_memory(src, self.img):
+                    self.img[...] = src.reshape(self.img.shape)
+                self.flush()
 
-        # imgCpy = np.copy(self.img)
-        # imgCpy = imgCpy & ~1
+        return self.img if inplace else dst.reshape(self.img.shape)
 
-        return imgCpy
+    def payloadRuns(self):
+        # The (first value, stop, bits per channel) runs of carrier values holding the payload; none without one
+        if self.payloadExists() == False:
+            return []
+
+        header = self.readHeader()
+        if header is None:
+            (count, content) = self.locatePayload()
+            return [(0, count * 3, 2)]
+
+        body = lsbSampleCount(header.length, header.bitsPerChannel)
+
+        return [(0, HEADER_SAMPLES, 2), (HEADER_SAMPLES, HEADER_SAMPLES + body, header.bitsPerChannel)]
 
-    def embedPayload(self, payload, override=False):
+    def embedPayload(self, payload, override=False, out=None, inplace=False, bitsPerChannel=2):
         # Check for type of payload
         if type(payload) != Payload:
             raise TypeError("The payload needs to be of type Payload.")
 
-        # Check if the payload can be embedded into the image or not
-        if len(self.img.shape) == 3:
-            payloadSize = len(payload.content)
-            maxSize = self.img.shape[0] * self.img.shape[1] * 3
+        with span("Carrier.embedPayload", len(payload.content)):
+            # Check if the payload can be embedded into the image or not
+            with span("payloadSegments", len(payload.content)):
+                segments = payloadSegments(payload, bitsPerChannel)
+            (start, values, depth) = segments[-1]
 
-            if payloadSize > maxSize:
+            if start + values.size > self.img.size:
                 raise ValueError("Payload size is larger than what the carrier can hold.")
 
-        if len(self.img.shape) == 2:
-            payloadSize = len(payload.content) * 3
-            maxSize = self.img.size
+            with span("payloadExists"):
+                if override == False and self.payloadExists() == True:
+                    raise Exception("Current carrier already contains a payload.")
 
-            if payloadSize > maxSize:
-                raise ValueError("Payload size is larger than what the carrier can hold.")
+            with span("outputBuffer", self.img.size):
+                out = self.outputBuffer(out, inplace)
+
+            # Only the prefix holding the payload is touched
+            for (start, values, depth) in segments:
+                with span("writeLsb", values.size):
+                    self.writeLsb(out, start, values, depth)
+
+            if out is self.img:
+                self.flush()
+
+        return out
+
+    def embedStream(self, img, compressionLevel=-1, codec="zlib", chunkSize=1 << 20, override=False, out=None,
+                    inplace=False, bitsPerChannel=2):
+        # Embeds a payload image as a binary (version 2) payload without ever holding its whole serialization:
+        # row blocks of the raster scan are compressed, packed into symbols and written as they are produced.
+        # Peak memory is a few times chunkSize. The header (with the final length) is written last.
+        if not isinstance(img, np.ndarray) or img.dtype not in PAYLOAD_DTYPES:
+            raise TypeError("The payload image must be a uint8 or uint16 numpy.ndarray.")
+
+        if compressionLevel < -1 or compressionLevel > 9:
+            raise ValueError("compressionLevel must be between -1 and 9, inclusive.")
+
+        if bitsPerChannel not in (1, 2, 3, 4):
+            raise ValueError("bitsPerChannel must be between 1 and 4, inclusive.")
 
         if override == False and self.payloadExists() == True:
             raise Exception("Current carrier already contains a payload.")
 
-        # imgCpy = np.copy(self.img)
+        # Uncompressed bodies have a known size, so they are rejected before anything is written
+        if compressionLevel == -1 and plannedContentBytes(img.shape, img.dtype, 2) > self.byteCapacity(bitsPerChannel):
+            raise ValueError("Payload size is larger than what the carrier can hold.")
 
-        # imgPart = imgCpy[0][:len(payload.content)]
-        # contentArr = np.copy(payload.content).reshape(imgPart.shape)
+        codec = getCodec(codec if compressionLevel != -1 else "none")
+        out = self.outputBuffer(out, inplace)
 
-        # high6Bits = (imgPart & ~0b11) # << np.array([0, 2, 4])).sum(axis=2)
-        # embeddedPart = high6Bits | (contentArr & 3)
+        # Compressed bodies only turn out too large while they are written. The header region is cleared first, so
+        # that a carrier written in place then holds no payload rather than a stale header over a partial body.
+        self.writeSymbols(out, 0, np.zeros(HEADER_SAMPLES // 3, dtype=np.uint8))
 
-        #otherImg = imgCpy[]
+        # The body starts right after the header, on a symbol boundary
+        (start, length, carry) = (HEADER_SAMPLES, 0, np.empty(0, dtype=np.uint8))
 
-        if self.img.ndim == 3:
-            contentArr = np.copy(payload.content)
-            imgCpy = (np.copy(self.img)).flat
+        try:
+            for chunk in compressChunks(rasterChunks(img, chunkSize), codec, compressionLevel):
+                length += chunk.size
+                (values, carry) = packLsb(carry, chunk, bitsPerChannel)
 
-            imgPart = imgCpy[0:len(payload.content) * 3]
+                if start + values.size > self.img.size:
+                    raise ValueError("Payload size is larger than what the carrier can hold.")
 
-            embeddedR = imgPart[::3]
-            embeddedG = imgPart[1::3]
-            embeddedB = imgPart[2::3]
+                self.writeLsb(out, start, values, bitsPerChannel)
+                start += values.size
 
-            embeddedR = (embeddedR & ~3) | (contentArr & 3)
-            embeddedG = (embeddedG & ~3) | ((contentArr & 12) >> 2)
-            embeddedB = (embeddedB & ~3) | ((contentArr & 48) >> 4)
+            values = bytesToLsb(carry, bitsPerChannel)
+            if start + values.size > self.img.size:
+                raise ValueError("Payload size is larger than what the carrier can hold.")
+            self.writeLsb(out, start, values, bitsPerChannel)
+        except BaseException:
+            if out is self.img:
+                self.flush()
+            raise
 
-            embeddedPart = np.array(self.completeArray(list(embeddedR), list(embeddedG), list(embeddedB)))
-            otherImg = imgCpy[len(payload.content) * 3:]
+        (row, col) = img.shape[:2]
+        channels = img.shape[2] if img.ndim == 3 else 1
+        payloadType = PAYLOAD_TYPES.index("Color" if img.ndim == 3 else "Gray")
+        header = PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, 2, payloadType, channels, PAYLOAD_DTYPES.index(img.dtype),
+                                     codec.id, compressionLevel, bitsPerChannel, row, col, length)
+        self.writeSymbols(out, 0, encode6Bit(header))
 
-            embeddedCarrier = np.append(embeddedPart, otherImg)
+        if out is self.img:
+            self.flush()
 
-            embeddedCarrier = np.reshape(embeddedCarrier, self.img.shape)
-            embeddedCarrier = np.uint8(embeddedCarrier)
+        return out
 
-        elif self.img.ndim == 2:
-            contentArr = np.copy(payload.content)
-            imgCpy = (np.copy(self.img)).flat
+    def outputBuffer(self, out, inplace):
+        # Pick the buffer to write into: the carrier itself, a caller-provided buffer or a new copy
+        if inplace:
+            out = self.img
+        elif out is None:
+            out = self.img.astype(np.uint8)
+        else:
+            if out.shape != self.img.shape or out.dtype != np.uint8:
+                raise ValueError("out must be a uint8 array with the same shape as the carrier.")
 
-            imgPart = (imgCpy[:len(contentArr) * 3]) & ~3
-            otherImg = imgCpy[len(contentArr) * 3:]
+            if out is not self.img:
+                np.copyto(out, self.img)
 
-            Rvals = (contentArr & 3)
-            Gvals = ((contentArr & 12) >> 2)
-            Bvals = ((contentArr & 48) >> 4)
+        if not out.flags.c_contiguous:
+            raise ValueError("The buffer being embedded into must be C-contiguous.")
 
-            fullCtn = np.vstack([Rvals, Gvals, Bvals])
-            fullCtn = np.transpose(fullCtn).flatten()
+        return out
 
-            embeddedCarrier = imgPart | fullCtn
-            embeddedCarrier = np.concatenate([embeddedCarrier, otherImg])
-            embeddedCarrier = np.reshape(embeddedCarrier, self.img.shape)
-            embeddedCarrier = np.uint8(embeddedCarrier)
+    def writeSymbols(self, out, start, symbols):
+        # Split every 6-bit symbol into three 2-bit parts and store them in the LSBs of 3 consecutive values
+        symbols = np.asarray(symbols).astype(np.uint8, copy=False)
+        samples = out.reshape(-1)[start * 3:(start + symbols.size) * 3].reshape(-1, 3)
 
-        return embeddedCarrier
+        samples &= np.uint8(0b11111100)
+        samples |= (symbols[:, np.newaxis] >> np.array([0, 2, 4], dtype=np.uint8)) & np.uint8(0b11)
 
-    def completeArray(self, rList, gList, bList):
-        fullImg = rList + gList + bList
+    def writeLsb(self, out, start, values, bitsPerChannel):
+        # Store values in the bitsPerChannel LSBs of the carrier values from start on
+        samples = out.reshape(-1)[start:start + values.size]
 
-        fullImg[::3] = rList
-        fullImg[1::3] = gList
-        fullImg[2::3] = bList
+        samples &= np.uint8(0xFF << bitsPerChannel & 0xFF)
+        samples |= values
 
-        return fullImg
+    def readLsb(self, start, count, bitsPerChannel):
+        return np.asarray(self.img.reshape(-1)[start:start + count]) & np.uint8((1 << bitsPerChannel) - 1)
 
     def extractPayload(self):
+        with span("Carrier.extractPayload") as extraction:
+            with span("payloadExists"):
+                if self.payloadExists() == False:
+                    raise Exception("The carrier does not contain a payload.")
+
+            # Only decode the pixels that the payload occupies
+            with span("locatePayload") as location:
+                (count, content) = self.locatePayload()
+                location.size = extraction.size = count
+
+            return Payload(content=content[:count])
+
+    def readSymbols(self, start, stop):
+        # Combine the two LSBs of every 3 consecutive carrier values (R, G, B of a pixel, or 3 gray pixels)
+        samples = np.asarray(self.img.reshape(-1)[start * 3:stop * 3]).reshape(-1, 3)
+
+        return (samples[:, 0] & 3) | ((samples[:, 1] & 3) << 2) | ((samples[:, 2] & 3) << 4)
+
+    def symbolCapacity(self):
+        return self.img.size // 3
+
+    def byteCapacity(self, bitsPerChannel=2):
+        return carrierCapacity(self.img.shape, bitsPerChannel)
+
+    def readHeader(self):
+        # The binary payload header, or None for XML payloads
+        return parsePayloadHeader(decode6Bit(self.readSymbols(0, PAYLOAD_HEADER.size * 4 // 3)))
+
+    def readBody(self, header, chunkSize=1 << 16):
+        # Yields the body bytes of a binary payload in chunks of about chunkSize bytes
+        depth = header.bitsPerChannel
+        samples = lsbSampleCount(header.length, depth)
+
+        if HEADER_SAMPLES + samples > self.img.size:
+            raise ValueError("The payload is larger than what the carrier can hold.")
+
+        # Every 72 values hold a whole number of bytes at any depth
+        step = max(1, chunkSize // (9 * depth)) * 72
+
+        for start in range(0, samples, step):
+            count = min(step, samples - start)
+            values = self.readLsb(HEADER_SAMPLES + start, count, depth)
+
+            yield lsbToBytes(values, depth, min(count * depth // 8, header.length - start * depth // 8))
+
+    def readXmlBody(self, bodyStart, chunkSize=1 << 16):
+        # Yields the body bytes of an XML payload whose body starts at byte bodyStart, decoding about chunkSize
+        # symbols at a time and parsing the decimal text up to the last complete value, until the closing tag
+        step = max(4, chunkSize // 4 * 4)
+        (start, skip, text) = (bodyStart // 3 * 4, bodyStart % 3, b"")
+
+        while start < self.symbolCapacity():
+            stop = min(start + step, self.symbolCapacity())
+            text += decode6Bit(self.readSymbols(start, stop)).tobytes()[skip:]
+            (start, skip) = (stop, 0)
+
+            # The body only holds digits and commas, so the first '<' is the start of '</payload>'
+            end = text.find(b"<")
+            if end != -1:
+                yield parseCsvBody(np.frombuffer(text[:end], dtype=np.uint8))
+                return
+
+            cut = text.rfind(b",")
+            if cut != -1:
+                yield parseCsvBody(np.frombuffer(text[:cut], dtype=np.uint8))
+                text = text[cut + 1:]
+
+        raise ValueError("The payload is missing its closing tag.")
+
+    def extractTo(self, path, chunkSize=1 << 16):
+        # Writes the payload image straight to a PNG file without rebuilding it in memory: the body is read (and
+        # for XML payloads parsed) chunk by chunk, inflated and encoded as rows as soon as they are complete.
+        # Returns the shape of the payload image.
         if self.payloadExists() == False:
-            raise Exception
-
-        # if self.img.ndim == 3:
-        #     header = self.img[0][:126]
-        #     headerList = list(((header & 0b11) << np.array([0, 2, 4])).sum(axis=1))
-        #     headerStr = self.get8bitSeq(headerList)
-        #     headerStr = str(base64.b64decode(headerStr))
-        #     print(headerStr)
-        #
-        #     pattern = r"type=\"([a-zA-Z]+)\" size=\"([0-9]+),([0-9]+)\" compressed=\"([a-zA-Z]+)\">"
-        #     vals = re.search(pattern, headerStr)
-        #
-        #     if vals:
-        #         row = int(vals.group(2))
-        #         col = int(vals.group(3))
-        #
-        #     print(row, col)
-        #
-        #     imgCpy = np.copy(self.img[:row][:col])
-        #     fulCtn = ((imgCpy & 0b11) << np.array([0, 2, 4])).sum(axis=2)
-        #     fulCtn = fulCtn.flat
-        #
-        #     encoded = self.get8bitSeq(fulCtn)
-        #     xmlString = base64.b64decode(encoded)
-        #     print(xmlString)
-        #     l = xmlString.split(b'</payload>')
-        #     xmlString = str(l[0] + b'</payload>')
-        #     # print(xmlString)
-        #
-        #     encoded = base64.b64encode(xmlString.encode('utf-8'))
-        #     l = self.get6BitSeq(list(encoded))
-        #
-        #     ctn = np.array(l, dtype=np.uint8)
-        #
-        # # return Payload(content=ctn)
-
-        if len(self.img.shape) == 3:
-            fulCtn = ((self.img & 0b11) << np.array([0, 2, 4])).sum(axis=2)
-            fulCtn = fulCtn.flatten()
-
-        elif self.img.ndim == 2:
-            imgCpy = np.copy(self.img).flat
-
-            list2d = np.array(list(zip(imgCpy[::3], imgCpy[1::3], imgCpy[2::3])))
-            fulCtn = list(((list2d & 0b11) << np.array([0, 2, 4])).sum(axis=1))
-            fulCtn = np.array(fulCtn)
-
-        return Payload(content=fulCtn)
-
-
-        # if len(self.img.shape) == 3:
-        #     fulCtn = ((self.img & 0b11) << np.array([0, 2, 4])).sum(axis=2)
-        #     fulCtn = fulCtn.flat
-        #
-        #     # Convert the radix 64 list into utf-8 list
-        #     encoded = self.get8bitSeq(fulCtn)
-        #
-        #     # Convert the utf-8 list into xmlString
-        #     xmlString = base64.b64decode(encoded)
-        #
-        #     l = xmlString.split(b'</payload>')
-        #     xmlString = str(l[0] + b'</payload>')
-        #
-        #     # Covert xmlString to base64 encoded data
-        #     encoded = base64.b64encode(xmlString.encode('utf-8'))
-        #
-        #     l = self.get6BitSeq(list(encoded))
-        #
-        #     # Convert the list to np.array() type
-        #     ctn = np.array(l, dtype=np.uint8)
-        #
-        # elif self.img.ndim == 2:
-        #     imgCpy = np.copy(self.img).flat
-        #
-        #     list2d = np.array(list(zip(imgCpy[::3], imgCpy[1::3], imgCpy[2::3])))
-        #     fulCtn = list(((list2d & 0b11) << np.array([0, 2, 4])).sum(axis=1))
-        #
-        #     # Convert the radix 64 list into utf-8 list
-        #     encoded = self.get8bitSeq(fulCtn)
-        #
-        #     # Convert the utf-8 list into xmlString
-        #     xmlString = base64.b64decode(encoded)
-        #
-        #     l = xmlString.split(b'</payload>')
-        #     xmlString = str(l[0] + b'</payload>')
-        #
-        #     # Covert xmlString to base64 encoded data
-        #     encoded = base64.b64encode(xmlString.encode('utf-8'))
-        #
-        #     l = self.get6BitSeq(list(encoded))
-        #
-        #     ctn = np.array(l, dtype=np.uint8)
-        #
-        # return Payload(content=ctn)
+            raise Exception("The carrier does not contain a payload.")
 
-    def get8bitSeq(self, l):
-        inv_map = self.numtoCharTable()
-        a = np.array(l)
+        header = self.readHeader()
+
+        # XML payloads declare their type and size in the <payload> tag
+        if header is None:
+            prefix = decode6Bit(self.readSymbols(0, symbolCount(XML_HEADER_SCAN))).tobytes()
+            (attributes, bodyStart) = parseXmlHeader(prefix)
+
+            (rows, cols) = map(int, attributes["size"].split(","))
+            (planes, dtype) = (3 if attributes["type"] == "Color" else 1, np.dtype(np.uint8))
+            codec = getCodec(attributes.get("codec", "zlib") if attributes["compressed"] == "True" else "none")
+            body = self.readXmlBody(bodyStart, chunkSize)
+        else:
+            (rows, cols) = (header.rows, header.cols)
+            (planes, dtype) = (header.channels if PAYLOAD_TYPES[header.type] == "Color" else 1,
+                               PAYLOAD_DTYPES[header.dtype])
+            codec = getCodec(header.codec)
+            body = self.readBody(header, chunkSize)
+
+        writeRasterPng(path, body, codec.decompressobj(), rows, cols, planes, dtype, chunkSize)
+
+        return (rows, cols, planes) if planes > 1 else (rows, cols)
+
+    def locatePayload(self, chunkSize=1 << 12, maxChunkSize=1 << 20):
+        # Returns the number of symbols the payload occupies, along with (at least) those symbols
+        header = self.readHeader()
+
+        # Binary payloads declare their length up front
+        if header is not None and header.bitsPerChannel == 2:
+            count = binaryContentLength(header.length)
+
+            if count > self.symbolCapacity():
+                raise ValueError("The payload is larger than what the carrier can hold.")
+
+            return count, self.readSymbols(0, count)
+
+        # Bodies embedded with another depth are gathered into bytes and re-packed as the 2 bits per channel content
+        if header is not None:
+            samples = lsbSampleCount(header.length, header.bitsPerChannel)
+
+            if HEADER_SAMPLES + samples > self.img.size:
+                raise ValueError("The payload is larger than what the carrier can hold.")
+
+            body = lsbToBytes(self.readLsb(HEADER_SAMPLES, samples, header.bitsPerChannel), header.bitsPerChannel,
+                              header.length)
+            head = np.frombuffer(PAYLOAD_HEADER.pack(*header._replace(bitsPerChannel=2)), dtype=np.uint8)
+            content = encode6Bit(np.concatenate([head, body]))
+
+            return content.size, content
+
+        # XML payloads are decoded in growing chunks until the closing tag is seen
+        terminator = b"</payload>"
+        (chunks, tail, decoded, start) = ([], b"", 0, 0)
 
-        l_map = np.vectorize(inv_map.get)(a)
-        l_map = l_map.flat
-        ret_str = "".join(map(str, list(l_map)))
+        while start < self.symbolCapacity():
+            # Chunks hold a multiple of 4 symbols so that every chunk (but the last) decodes to whole bytes
+            stop = min(start + chunkSize, self.symbolCapacity())
+            chunks.append(self.readSymbols(start, stop))
+            data = tail + decode6Bit(chunks[-1]).tobytes()
 
-        if (len(l) * 3 % 4) == 2:
-            ret_str += "=="
-        elif (len(l) * 3 % 4) == 1:
-            ret_str += "="
+            found = data.find(terminator)
+            if found != -1:
+                end = decoded - len(tail) + found + len(terminator)
+                return symbolCount(end), np.concatenate(chunks)
 
-        ret_str = bytes(ret_str, 'utf-8')
+            decoded += len(data) - len(tail)
+            tail = data[-(len(terminator) - 1):]
+            start = stop
+            chunkSize = min(chunkSize * 2, maxChunkSize)
 
-        return ret_str
+        raise ValueError("The payload is missing its closing tag.")
+
+    def get8bitSeq(self, l):
+        return sixBitToChars(l)
 
     def numtoCharTable(self):
-        d = {0: 'A',
-             1: 'B',
-             2: 'C',
-             3: 'D',
-             4: 'E',
-             5: 'F',
-             6: 'G',
-             7: 'H',
-             8: 'I',
-             9: 'J',
-             10: 'K',
-             11: 'L',
-             12: 'M',
-             13: 'N',
-             14: 'O',
-             15: 'P',
-             16: 'Q',
-             17: 'R',
-             18: 'S',
-             19: 'T',
-             20: 'U',
-             21: 'V',
-             22: 'W',
-             23: 'X',
-             24: 'Y',
-             25: 'Z',
-             26: 'a',
-             27: 'b',
-             28: 'c',
-             29: 'd',
-             30: 'e',
-             31: 'f',
-             32: 'g',
-             33: 'h',
-             34: 'i',
-             35: 'j',
-             36: 'k',
-             37: 'l',
-             38: 'm',
-             39: 'n',
-             40: 'o',
-             41: 'p',
-             42: 'q',
-             43: 'r',
-             44: 's',
-             45: 't',
-             46: 'u',
-             47: 'v',
-             48: 'w',
-             49: 'x',
-             50: 'y',
-             51: 'z',
-             52: '0',
-             53: '1',
-             54: '2',
-             55: '3',
-             56: '4',
-             57: '5',
-             58: '6',
-             59: '7',
-             60: '8',
-             61: '9',
-             62: '+',
-             63: '/'
-             }
-
-        return d
+        return {i: chr(c) for (i, c) in enumerate(RADIX64_ALPHABET)}
 
     def get6BitSeq(self, l):
-        table = self.charToNumTable()
-        l_ret = []
+        return charsTo6Bit(l)
 
-        if l[-1] == 61 and l[-2] == 61:
-            l = l[:-2]
-        elif l[-1] == 61:
-            l = l[:-1]
+    def charToNumTable(self):
+        return {c: i for (i, c) in enumerate(RADIX64_ALPHABET)}
 
-        a = np.array(l)
 
-        l_map = np.vectorize(table.get)(a)
-        #print(list(l_map))
 
-        return list(l_map)
+def symbolCount(byteCount):
+    # Number of 6-bit symbols needed for byteCount bytes
+    return -(-byteCount * 4 // 3)
 
-    def charToNumTable(self):
-        d = {43: 62,
-             47: 63,
-             48: 52,
-             49: 53,
-             50: 54,
-             51: 55,
-             52: 56,
-             53: 57,
-             54: 58,
-             55: 59,
-             56: 60,
-             57: 61,
-             65: 0,
-             66: 1,
-             67: 2,
-             68: 3,
-             69: 4,
-             70: 5,
-             71: 6,
-             72: 7,
-             73: 8,
-             74: 9,
-             75: 10,
-             76: 11,
-             77: 12,
-             78: 13,
-             79: 14,
-             80: 15,
-             81: 16,
-             82: 17,
-             83: 18,
-             84: 19,
-             85: 20,
-             86: 21,
-             87: 22,
-             88: 23,
-             89: 24,
-             90: 25,
-             97: 26,
-             98: 27,
-             99: 28,
-             100: 29,
-             101: 30,
-             102: 31,
-             103: 32,
-             104: 33,
-             105: 34,
-             106: 35,
-             107: 36,
-             108: 37,
-             109: 38,
-             110: 39,
-             111: 40,
-             112: 41,
-             113: 42,
-             114: 43,
-             115: 44,
-             116: 45,
-             117: 46,
-             118: 47,
-             119: 48,
-             120: 49,
-             121: 50,
-             122: 51
-             }
-
-        return d
 
+def csvLength(values):
+    # Length of the values (uint8) written as comma separated decimal text, without building the text
+    values = np.asarray(values, dtype=np.uint8)
 
-if __name__ == "__main__":
-    # img = np.arange(30).reshape(2, 5, 3)
-    # # img2d = np.arange(30).reshape(2, 5, 3)
-    # cLevel = 3
-    # encoded = [15, 3, 61, 56, 27, 22, 48, 32, 29, 38, 21, 50, 28, 54, 37, 47, 27, 35, 52, 34, 12, 18, 56, 48, 8, 34, 1,
-    #            37, 27, 38, 13, 47, 25, 6, 37, 46, 25, 51, 52, 34, 21, 21, 17, 6, 11, 19, 32, 34, 15, 51, 56, 60, 28, 6,
-    #            5, 57, 27, 6, 61, 33, 25, 2, 1, 52, 30, 23, 1, 37, 15, 18, 9, 3, 27, 54, 49, 47, 28, 34, 8, 32, 28, 54,
-    #            37, 58, 25, 19, 52, 34, 12, 34, 48, 53, 8, 34, 1, 35, 27, 54, 53, 48, 28, 38, 21, 51, 28, 54, 21, 36, 15,
-    #            18, 9, 20, 28, 39, 21, 37, 8, 35, 56, 49, 12, 35, 0, 44, 14, 19, 16, 44, 14, 19, 36, 44, 14, 19, 24, 44,
-    #            12, 19, 0, 50, 11, 3, 8, 50, 13, 50, 48, 50, 12, 35, 32, 44, 12, 35, 8, 53, 11, 3, 8, 51, 11, 3, 4, 56,
-    #            11, 3, 4, 52, 14, 18, 48, 49, 13, 3, 16, 44, 12, 19, 0, 50, 11, 3, 4, 48, 12, 2, 48, 57, 13, 50, 48, 50,
-    #            12, 51, 4, 44, 12, 35, 8, 54, 11, 3, 8, 49, 11, 3, 4, 54, 11, 3, 8, 50, 11, 3, 4, 52, 13, 50, 48, 49, 13,
-    #            3, 32, 44, 14, 19, 28, 44, 14, 19, 32, 44, 12, 35, 8, 57, 11, 3, 8, 50, 13, 2, 48, 50, 12, 51, 0, 44, 12,
-    #            19, 36, 44, 12, 35, 0, 44, 12, 19, 28, 44, 12, 19, 20, 49, 11, 3, 4, 52, 13, 34, 48, 53, 11, 3, 0, 44,
-    #            12, 35, 8, 44, 12, 19, 36, 56, 11, 3, 4, 44, 12, 19, 32, 48, 15, 2, 61, 48, 24, 23, 37, 44, 27, 54, 5,
-    #            36, 15, 32]
-    #
-    # encodedGray = [15, 3, 61, 56, 27, 22, 48, 32, 29, 38, 21, 50, 28, 54, 37, 47, 27, 35, 52, 34, 12, 18, 56, 48, 8, 34, 1,
-    #                37, 27, 38, 13, 47, 25, 6, 37, 46, 25, 51, 52, 34, 21, 21, 17, 6, 11, 19, 32, 34, 15, 51, 56, 60, 28, 6,
-    #                5, 57, 27, 6, 61, 33, 25, 2, 1, 52, 30, 23, 1, 37, 15, 18, 9, 7, 28, 38, 5, 57, 8, 34, 1, 51, 26, 23, 41,
-    #                37, 15, 18, 8, 51, 11, 3, 4, 48, 8, 34, 1, 35, 27, 54, 53, 48, 28, 38, 21, 51, 28, 54, 21, 36, 15, 18, 9,
-    #                20, 28, 39, 21, 37, 8, 35, 56, 49, 12, 35, 0, 44, 14, 19, 16, 44, 14, 19, 36, 44, 14, 19, 24, 44, 12, 19,
-    #                0, 48, 11, 3, 36, 56, 11, 3, 4, 48, 12, 34, 48, 57, 13, 50, 48, 49, 12, 3, 4, 44, 14, 19, 36, 44, 12, 35,
-    #                12, 49, 11, 3, 8, 50, 13, 2, 48, 50, 12, 35, 32, 44, 12, 35, 8, 54, 11, 3, 8, 51, 12, 2, 48, 50, 12, 35,
-    #                20, 44, 12, 35, 8, 57, 11, 3, 8, 50, 13, 50, 48, 50, 12, 50, 48, 49, 13, 34, 48, 50, 12, 2, 48, 49, 14,
-    #                2, 48, 50, 12, 34, 48, 49, 13, 50, 48, 50, 12, 18, 48, 49, 14, 18, 48, 49, 13, 19, 4, 44, 12, 19, 16,
-    #                52, 11, 3, 4, 52, 14, 2, 48, 49, 13, 3, 24, 44, 12, 19, 20, 48, 11, 3, 4, 52, 13, 18, 48, 53, 11, 3,
-    #                0, 44, 12, 19, 28, 44, 12, 19, 28, 51, 11, 3, 4, 44, 12, 19, 32, 48, 15, 2, 61, 48, 24, 23, 37, 44, 27,
-    #                54, 5, 36, 15, 32]
-    #
-#     ctn = np.array(encoded)
-    # ctnGray = np.array(encodedGray)
-    # # print(img)
-    # toHideImg = Payload(img, cLevel, None)
-    # toHideContent = Payload(img=None, compressionLevel=cLevel, content=ctn)
-    #
-    # payloadGrayimg = Payload(img2d, cLevel, None)
-    # payloadGrayctn = Payload(img=None, compressionLevel=cLevel, content=ctnGray)
-    # # print(payloadGrayctn.img)
-    #
-    # # print(toHideImg.img)
-    # # print(toHideImg.content)
-    #
-    # img = np.arange(30, 60).reshape(2, 5, 3)
-    # img = np.uint8(img)
-    # print()
-    # # print(img)
-    # shapeOfYou = Carrier(img)
-    # l = shapeOfYou.embedPayload(toHideImg, False)
-    # # shapeOfYou.extractPayload()
-
-    # l = [1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 3, 0, 0]
-    # c1 = Carrier(np.array(l).reshape((2, 5, 3)))
-    # c1.extractPayload()
-
-    c = Carrier(imread("result1_9.png"))
-    # c.payloadExists()
-    c.extractPayload()
-    # # c.embedPayload()
-
-    # cGray = Carrier(imread("result3_3.png"))
-    # pGray = Payload(img=imread("payload3.png"), compressionLevel=3)
-    # val = cGray.payloadExists()
-    # print(val)
-    # cGray.embedPayload(payload=pGray, override=True)
-    # cGray.extractPayload()
-
-    #
-    # pColor = Payload(img=imread("payload1.png"), compressionLevel=9)
-    # c = Carrier(imread("carrier1.png"))
-    #
-    # c.embedPayload(pColor)
-
-    # c1 = Carrier(img)
-    # p1 = Payload(content=ctn)
-    # ec = c1.embedPayload(p1)
-    # print("Embedded Payload")
-    # print(ec)
-    #
-    #
-    # testPload = c1.extractPayload()
-    # print(testPload.img)
+    if values.size == 0:
+        return 0
+
+    return 2 * values.size - 1 + int(np.count_nonzero(values >= 10)) + int(np.count_nonzero(values >= 100))
+
+
+def xmlContentLength(payloadType, rows, cols, compressed, body, codec="zlib"):
+    # Number of symbols of an XML payload with the given (possibly compressed) body bytes
+    head = xmlPayloadHead(payloadType, rows, cols, compressed, codec)
+
+    return symbolCount(len(head) + csvLength(body) + len("</payload>"))
+
+
+def binaryContentLength(bodyLength):
+    # Number of symbols of a binary payload with a body of bodyLength bytes
+    return symbolCount(PAYLOAD_HEADER.size + bodyLength)
+
+
+def plannedContentBytes(shape, dtype=np.uint8, version=1, compressedBytes=None, codec="zlib", csvBytes=None):
+    # Length in bytes of the content of a payload with the given shape, before it is packed into symbols, without
+    # building it. compressedBytes is the length of the compressed body, or None for an uncompressed payload.
+    # Binary payloads are exact. XML payloads spell the body out as decimal text, so they are exact only when
+    # csvBytes (the csvLength() of the body) is given, and otherwise assume the worst case of three digits per byte.
+    if version != 2 and len(shape) == 3:
+        shape = tuple(shape[:2]) + (min(shape[2], 3), )
+
+    body = compressedBytes
+    if body is None:
+        body = functools.reduce(operator.mul, shape, 1) * np.dtype(dtype).itemsize
+
+    if version == 2:
+        return PAYLOAD_HEADER.size + body
+
+    if csvBytes is None:
+        csvBytes = max(4 * body - 1, 0)
+
+    head = xmlPayloadHead("Color" if len(shape) == 3 else "Gray", shape[0], shape[1], compressedBytes is not None,
+                          codec)
+
+    return len(head) + csvBytes + len("</payload>")
+
+
+def carrierCapacity(shape, bitsPerChannel=2):
+    # Number of content bytes a carrier with the given shape holds. At 2 bits per channel every 3 values hold a
+    # symbol (3 bytes per 4 symbols); other depths keep the binary header at 2 bits and use the rest for the body.
+    samples = functools.reduce(operator.mul, shape, 1)
+
+    if bitsPerChannel == 2:
+        return samples // 3 * 3 // 4
+
+    if samples < HEADER_SAMPLES:
+        return 0
+
+    return PAYLOAD_HEADER.size + (samples - HEADER_SAMPLES) // 3 * 3 * bitsPerChannel // 8
+
+
+# Memoized results of contentSizes(), keyed by payloadDigest()
+_sweepResults = OrderedDict()
+_sweepLock = threading.Lock()
+
+
+def contentSizes(img, levels=range(-1, 10), version=1, workers=None, codec="zlib"):
+    # Returns {compressionLevel: content length in symbols} for every level without building any Payload.
+    # The raster scan is shared and the levels are compressed concurrently (the stdlib codecs release the GIL).
+    codec = getCodec(codec)
+    key = payloadDigest(img, "sweep", version, codec.name)
+
+    with _sweepLock:
+        known = dict(_sweepResults.get(key, {}))
+
+    missing = [level for level in levels if level not in known]
+
+    if missing:
+        if version == 2:
+            fullImg = rasterScan(img).astype(img.dtype.newbyteorder("<"), copy=False).view(np.uint8)
+        else:
+            fullImg = rasterScan(xmlPlanes(img))
+
+        (rows, cols) = img.shape[:2]
+        payloadType = "Color" if img.ndim == 3 else "Gray"
+
+        def size(level):
+            body = fullImg if level == -1 else np.frombuffer(codec.compress(fullImg, level), dtype=np.uint8)
+
+            if version == 2:
+                return binaryContentLength(body.size)
+
+            return xmlContentLength(payloadType, rows, cols, level != -1, body, codec.name)
+
+        with ThreadPoolExecutor(max_workers=workers or len(missing)) as pool:
+            known.update(zip(missing, pool.map(size, missing)))
+
+        with _sweepLock:
+            _sweepResults[key] = known
+            _sweepResults.move_to_end(key)
+
+            while len(_sweepResults) > 32:
+                _sweepResults.popitem(last=False)
+
+    return {level: known[level] for level in levels}
+
+
+def payloadDigest(img, compressionLevel=-1, version=1, codec="zlib"):
+    # Fast digest of a payload image together with everything that changes its content
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((img.shape, img.dtype.str, compressionLevel, version, codec)).encode())
+    digest.update(np.ascontiguousarray(img).reshape(-1).view(np.uint8))
+
+    return digest.hexdigest()
+
+
+class PayloadCache:
+    # Caches Payload content by payloadDigest(): an in-memory LRU tier bounded by maxBytes, and an optional
+    # on-disk tier of .npy files in folder, bounded by maxDiskBytes (the least recently used files are removed)
+    def __init__(self, maxBytes=256 << 20, folder=None, maxDiskBytes=1 << 30):
+        self.maxBytes = maxBytes
+        self.folder = folder
+        self.maxDiskBytes = maxDiskBytes
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def get(self, img, compressionLevel=-1, version=1, codec="zlib"):
+        key = payloadDigest(img, compressionLevel, version, codec)
+        content = self.lookup(key)
+
+        if content is None:
+            content = Payload(img, compressionLevel, version=version, codec=codec).content
+            self.store(key, content)
+
+        return Payload(img=img, content=content, version=version, codec=codec)
+
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        path = self.diskPath(key)
+        if path is not None and os.path.exists(path):
+            try:
+                content = np.load(path)
+            except (OSError, ValueError):
+                content = None
+
+            if content is not None:
+                os.utime(path)
+                with self.lock:
+                    self.diskHits += 1
+                self.remember(key, content)
+                return content
 
+        with self.lock:
+            self.misses += 1
+        return None
 
+    def store(self, key, content):
+        self.remember(key, content)
+
+        path = self.diskPath(key)
+        if path is None:
+            return
+
+        # Write to a temporary name first so that other processes never load a partial file
+        temp = "%s.%d.tmp.npy" % (path[:-4], os.getpid())
+        np.save(temp, content)
+        os.replace(temp, path)
+
+        self.evictDisk()
+
+    def remember(self, key, content):
+        if content.nbytes > self.maxBytes:
+            return
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = content
+                self.size += content.nbytes
+
+            while self.size > self.maxBytes:
+                (oldKey, oldContent) = self.entries.popitem(last=False)
+                self.size -= oldContent.nbytes
+
+    def diskPath(self, key):
+        return None if self.folder is None else os.path.join(self.folder, key + ".npy")
+
+    def evictDisk(self):
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".npy") and ".tmp." not in name:
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for (mtime, size, name) in files)
+        for (mtime, size, name) in sorted(files):
+            if total <= self.maxDiskBytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "diskHits": self.diskHits, "misses": self.misses,
+                "entries": len(self.entries), "bytes": self.size}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def writeRasterPng(path, body, decompressor, rows, cols, planes, dtype, chunkSize=1 << 16):
+    # Encodes the (compressed) raster scan of an image, given as chunks of bytes, to a PNG file. Rows are written
+    # as soon as they are complete. The planes before the last one are spilled to a temporary file and interleaved
+    # with the last plane as it arrives.
+    rowBytes = cols * dtype.itemsize
+    lastPlane = (planes - 1) * rows * rowBytes
+
+    def inflated():
+        for chunk in body:
+            # Small slices bound what a single call inflates to, even for very compressible bodies
+            for start in range(0, chunk.size, 1 << 12):
+                yield decompressor.decompress(chunk[start:start + (1 << 12)])
+
+        yield decompressor.flush() if hasattr(decompressor, "flush") else b""
+
+    with tempfile.TemporaryFile() as spill, PngWriter(path, cols, rows, planes, 8 * dtype.itemsize) as writer:
+        if planes > 1:
+            spill.truncate(lastPlane)
+            earlier = np.memmap(spill, dtype=dtype, shape=(planes - 1, rows, cols))
+
+        (pending, pos) = (bytearray(), 0)
+
+        for data in inflated():
+            pending += data
+
+            if pos < lastPlane:
+                used = min(len(pending), lastPlane - pos)
+                earlier.reshape(-1).view(np.uint8)[pos:pos + used] = np.frombuffer(bytes(pending[:used]), np.uint8)
+                del pending[:used]
+                pos += used
+
+            while pos >= lastPlane and len(pending) >= rowBytes:
+                count = min(len(pending), max(chunkSize, rowBytes)) // rowBytes
+
+                if pos + count * rowBytes > lastPlane + rows * rowBytes:
+                    raise ValueError("The payload body is larger than its declared size.")
+
+                row = (pos - lastPlane) // rowBytes
+                block = np.frombuffer(bytes(pending[:count * rowBytes]), dtype=dtype).reshape(count, cols)
+
+                if planes > 1:
+                    block = np.stack(list(earlier[:, row:row + count]) + [block], axis=-1)
+
+                writer.writeRows(block)
+                del pending[:count * rowBytes]
+                pos += count * rowBytes
+
+        if pending or pos != lastPlane + rows * rowBytes:
+            raise ValueError("The payload body does not match its declared size.")
+
+        if planes > 1:
+            del earlier
+
+
+def payloadExistsInFile(path):
+    # Checks a carrier file for a payload. For PNG files only the first pixels of the first scanline are
+    # inflated and unfiltered; other formats (and PNG layouts that are not handled) are fully decoded.
+    try:
+        pixels = readLeadingPixels(path, values=21)
+
+        if pixels.ndim == 1:
+            return Carrier(pixels[np.newaxis]).payloadExists()
+        if pixels.shape[1] == 3:
+            return Carrier(pixels[np.newaxis]).payloadExists()
+    except (UnsupportedPng, OSError):
+        pass
+
+    return Carrier(imread(path)).payloadExists()
+
+
+def embedFile(payload, carrierPath, outPath, bandRows=256, override=False, bitsPerChannel=2, level=6):
+    # Embeds into a PNG carrier band by band: rows are decoded, the bands that overlap the payload are embedded,
+    # the rest pass through untouched, and everything is encoded to outPath as it goes. Only one band of the
+    # carrier is in memory at a time. Returns the shape of the carrier.
+    if type(payload) != Payload:
+        raise TypeError("The payload needs to be of type Payload.")
+
+    segments = payloadSegments(payload, bitsPerChannel)
+
+    with PngReader(carrierPath) as reader:
+        if reader.channels not in (1, 3):
+            raise UnsupportedPng("Only gray and RGB carriers are supported.")
+
+        (start, values, depth) = segments[-1]
+        if start + values.size > reader.height * reader.width * reader.channels:
+            raise ValueError("Payload size is larger than what the carrier can hold.")
+
+        # The first band covers at least the payload prefix, and is checked before anything is written
+        band = reader.readRows(max(bandRows, -(-21 // (reader.width * reader.channels))))
+        if override == False and Carrier(band).payloadExists() == True:
+            raise Exception("Current carrier already contains a payload.")
+
+        # The output is written next to outPath and only replaces it once it is complete
+        tempPath = "%s.%d-%d.tmp" % (outPath, os.getpid(), threading.get_ident())
+
+        try:
+            with PngWriter(tempPath, reader.width, reader.height, reader.channels, level=level) as writer:
+                offset = 0
+
+                while True:
+                    carrier = Carrier(band)
+
+                    for (start, values, depth) in segments:
+                        (first, last) = (max(start, offset), min(start + values.size, offset + band.size))
+
+                        if first < last:
+                            carrier.writeLsb(band, first - offset, values[first - start:last - start], depth)
+
+                    writer.writeRows(band)
+                    offset += band.size
+
+                    if reader.rowsRead == reader.height:
+                        break
+                    band = reader.readRows(bandRows)
+
+            os.replace(tempPath, outPath)
+        except BaseException:
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+            raise
+
+        return reader.shape
+
+
+def shareArray(arr):
+    # Copy an array into a new shared memory block; returns the block and a picklable description of the array
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def attachArray(spec):
+    # Attach to an array shared by shareArray() in another process
+    (name, shape, dtype) = spec
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def embedWorker(payloadSpec, carrierSpec, compressionLevel, version, override, codec, bitsPerChannel=2):
+    # Runs in a pool process: serializes the payload and embeds it in place into the shared carrier
+    (payloadShm, payloadImg) = attachArray(payloadSpec)
+    (carrierShm, carrierImg) = attachArray(carrierSpec)
+
+    try:
+        payload = Payload(payloadImg, compressionLevel, version=version, codec=codec)
+        Carrier(carrierImg).embedPayload(payload, override=override, inplace=True, bitsPerChannel=bitsPerChannel)
+    finally:
+        # The views must be released before the blocks can be closed
+        payload = payloadImg = carrierImg = None
+        payloadShm.close()
+        carrierShm.close()
+
+
+def embedMany(pairs, workers=None, compressionLevel=-1, version=1, override=False, codec="zlib", bitsPerChannel=2):
+    # Embeds every (payload image, carrier image) pair on a process pool and yields the embedded carriers in order.
+    # The images travel through shared memory instead of being pickled, and at most 2 jobs per worker are in flight.
+    workers = workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = 2 * workers
+        pending = deque()
+
+        def release(*blocks):
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        def collect():
+            (future, payloadShm, carrierShm, carrierSpec) = pending.popleft()
+
+            try:
+                future.result()
+                result = np.array(np.ndarray(carrierSpec[1], dtype=np.dtype(carrierSpec[2]), buffer=carrierShm.buf))
+            finally:
+                release(payloadShm, carrierShm)
+
+            return result
+
+        try:
+            for (payloadImg, carrierImg) in pairs:
+                (payloadShm, payloadSpec) = shareArray(payloadImg)
+                try:
+                    (carrierShm, carrierSpec) = shareArray(np.asarray(carrierImg, dtype=np.uint8))
+                except BaseException:
+                    release(payloadShm)
+                    raise
+
+                pending.append((None, payloadShm, carrierShm, carrierSpec))
+                future = pool.submit(embedWorker, payloadSpec, carrierSpec, compressionLevel, version, override,
+                                     codec, bitsPerChannel)
+                pending[-1] = (future, payloadShm, carrierShm, carrierSpec)
+
+                if len(pending) >= window:
+                    yield collect()
+
+            while pending:
+                yield collect()
+        finally:
+            # When a job fails or the caller stops early, the blocks of the jobs still in flight are released too
+            # (a job that has not attached yet then fails, and its error is dropped)
+            while pending:
+                (future, payloadShm, carrierShm, carrierSpec) = pending.popleft()
+                if future is not None:
+                    future.cancel()
+                release(payloadShm, carrierShm)
+
+
+# Extensions picked up when a directory is given on the command line
+IMAGE_EXTENSIONS = (".png", ".bmp", ".tif", ".tiff", ".jpg", ".jpeg")
+
+
+def expandPaths(args):
+    # Expand directories (with their subfolders) and glob patterns (** matches any depth) into a list of image
+    # files, each listed once
+    paths = []
+
+    for arg in args:
+        if os.path.isdir(arg):
+            for (folder, subfolders, names) in os.walk(arg):
+                subfolders.sort()
+                paths += [os.path.join(folder, name) for name in sorted(names)
+                          if name.lower().endswith(IMAGE_EXTENSIONS)]
+        elif glob.has_magic(arg):
+            paths += sorted(glob.glob(arg, recursive=True))
+        else:
+            paths.append(arg)
+
+    return list(OrderedDict.fromkeys(paths))
+
+
+def commonRoot(paths):
+    # The deepest folder holding every path
+    return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else None
+
+
+def outputName(path, root):
+    # The output name of an input, without extension: its path relative to root, so that inputs with the same
+    # name in different folders do not overwrite each other's output
+    return os.path.splitext(os.path.relpath(os.path.abspath(path), root) if root else os.path.basename(path))[0]
+
+
+def outputPath(path, folder, suffix="", root=None):
+    target = os.path.join(folder, outputName(path, root) + suffix + ".png")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    return target
+
+
+@functools.lru_cache(maxsize=4)
+def cliPayload(path, compressionLevel, version, codec, cacheFolder):
+    # Every pool process serializes the shared payload once; the on-disk cache shares it across processes and runs
+    if cacheFolder is None:
+        return Payload(imread(path), compressionLevel, version=version, codec=codec)
+
+    return PayloadCache(folder=cacheFolder).get(imread(path), compressionLevel, version, codec)
+
+
+def cliEmbed(path, args):
+    if args.profile:
+        (args.codec, args.compression) = CODEC_PROFILES[args.profile]
+
+    payload = cliPayload(args.payload, args.compression, args.format, args.codec, args.cache)
+
+    target = outputPath(path, args.output, root=args.root)
+
+    # PNG carriers can be streamed band by band instead of being decoded whole; layouts the streaming reader does
+    # not handle (alpha, palette, 16-bit, interlaced) are decoded whole instead
+    if args.bands and path.lower().endswith(".png"):
+        try:
+            shape = embedFile(payload, path, target, args.bands, args.override, args.bits)
+
+            return functools.reduce(operator.mul, shape, 1), "embedded %d symbols" % len(payload.content)
+        except UnsupportedPng:
+            pass
+
+    carrier = Carrier(imread(path))
+    imsave(target, carrier.embedPayload(payload, override=args.override, inplace=True, bitsPerChannel=args.bits))
+
+    return carrier.img.nbytes, "embedded %d symbols" % len(payload.content)
+
+
+def cliExtract(path, args):
+    # The payload is streamed to its file instead of being rebuilt in memory
+    carrier = Carrier(imread(path))
+    shape = carrier.extractTo(outputPath(path, args.output, "_payload", args.root))
+
+    return carrier.img.nbytes, "payload %s" % "x".join(map(str, shape))
+
+
+def cliScan(path, args):
+    return os.path.getsize(path), "payload" if payloadExistsInFile(path) else "empty"
+
+
+def cliSizes(path, args):
+    img = imread(path)
+    sizes = contentSizes(img, version=args.format, codec=args.codec)
+
+    return img.nbytes, "  ".join("%d: %d" % (level, size) for (level, size) in sizes.items())
+
+
+def cliClean(path, args):
+    carrier = Carrier(imread(path))
+    carrier.clean(inplace=True, region=args.region, seed=args.seed, workers=1)
+    imsave(outputPath(path, args.output, root=args.root) if args.output else path, carrier.img)
+
+    return carrier.img.nbytes, "cleaned"
+
+
+def cliRun(command, path, args):
+    # Runs one command on one file in a pool process; failures are reported instead of raised
+    begin = time.perf_counter()
+
+    try:
+        (size, message) = command(path, args)
+        ok = True
+    except Exception as e:
+        (size, message, ok) = (0, "%s: %s" % (type(e).__name__, e), False)
+
+    return path, ok, size, time.perf_counter() - begin, message
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Steganography",
+                                     description="Embed, extract, detect and clean image payloads in bulk.")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    embed = commands.add_parser("embed", help="embed one payload into every carrier")
+    embed.add_argument("payload", help="payload image")
+    embed.add_argument("carriers", nargs="+", help="carrier images, directories or globs")
+    embed.add_argument("-o", "--output", required=True, help="folder for the embedded carriers")
+    embed.add_argument("-c", "--compression", type=int, default=-1, help="compression level, -1 to disable")
+    embed.add_argument("--format", type=int, choices=(1, 2), default=1, help="payload format version")
+    embed.add_argument("--codec", choices=list(CODECS), default="zlib", help="compression codec")
+    embed.add_argument("--profile", choices=sorted(CODEC_PROFILES), help="codec and level preset")
+    embed.add_argument("--override", action="store_true", help="replace existing payloads")
+    embed.add_argument("--bits", type=int, choices=(1, 2, 3, 4), default=2,
+                       help="carrier bits per channel (other than 2 needs --format 2)")
+    embed.add_argument("--cache", help="folder for the on-disk payload content cache")
+    embed.add_argument("--bands", type=int, metavar="ROWS",
+                       help="stream PNG carriers in bands of ROWS rows instead of decoding them whole")
+    embed.set_defaults(run=cliEmbed)
+
+    extract = commands.add_parser("extract", help="extract the payload of every carrier")
+    extract.add_argument("carriers", nargs="+", help="carrier images, directories or globs")
+    extract.add_argument("-o", "--output", required=True, help="folder for the extracted payloads")
+    extract.set_defaults(run=cliExtract)
+
+    scan = commands.add_parser("scan", help="report which carriers hold a payload")
+    scan.add_argument("carriers", nargs="+", help="carrier images, directories or globs")
+    scan.set_defaults(run=cliScan)
+
+    sizes = commands.add_parser("sizes", help="content length of every payload at every compression level")
+    sizes.add_argument("carriers", metavar="payloads", nargs="+", help="payload images, directories or globs")
+    sizes.add_argument("--format", type=int, choices=(1, 2), default=1, help="payload format version")
+    sizes.add_argument("--codec", choices=list(CODECS), default="zlib", help="compression codec")
+    sizes.set_defaults(run=cliSizes)
+
+    clean = commands.add_parser("clean", help="randomize the LSBs of every carrier")
+    clean.add_argument("carriers", nargs="+", help="carrier images, directories or globs")
+    clean.add_argument("-o", "--output", help="folder for the cleaned carriers (default: overwrite)")
+    clean.add_argument("--region", choices=("all", "payload"), default="all",
+                       help="randomize every value or only the values holding the payload")
+    clean.add_argument("--seed", type=int, help="seed for reproducible cleaning")
+    clean.set_defaults(run=cliClean)
+
+    args = parser.parse_args(argv)
+    paths = expandPaths(args.carriers)
+    run = args.run
+
+    # Nothing to do is an error, so that scripts notice a wrong path or pattern
+    if not paths:
+        parser.error("no image files found in %s" % ", ".join(args.carriers))
+    args.root = commonRoot(paths)
+
+    if getattr(args, "output", None):
+        # Inputs that only differ by extension would still write the same output
+        names = [outputName(path, args.root) for path in paths]
+        collisions = sorted(name for (name, count) in Counter(names).items() if count > 1)
+        if collisions:
+            parser.error("several inputs would write the same output: %s" % ", ".join(collisions))
+
+        os.makedirs(args.output, exist_ok=True)
+
+    # The pool processes only need the plain options
+    del args.run
+    (begin, total, failures) = (time.perf_counter(), 0, 0)
+
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1)) as pool:
+        futures = [pool.submit(cliRun, run, path, args) for path in paths]
+
+        for (done, future) in enumerate(as_completed(futures), 1):
+            (path, ok, size, duration, message) = future.result()
+            (total, failures) = (total + size, failures + (not ok))
+
+            print("[%d/%d] %s %s  %.1f MB  %.3f s  %.1f MB/s  %s" % (done, len(paths), "ok " if ok else "ERR", path,
+                  size / 1e6, duration, size / 1e6 / max(duration, 1e-9), message), flush=True)
+
+    elapsed = time.perf_counter() - begin
+    print("%d files, %d failed, %.1f MB in %.2f s (%.1f MB/s)" % (len(paths), failures, total / 1e6, elapsed,
+                                                                   total / 1e6 / max(elapsed, 1e-9)))
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
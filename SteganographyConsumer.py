@@ -2,14 +2,67 @@
 import sys
 from PySide.QtCore import *
 from PySide.QtGui import *
-from scipy.misc import imread
 from scipy.misc import imsave
 
 from SteganographyGUI import *
 import Steganography
+from SteganographyWorkers import WorkerPool
+from SteganographyPreview import toQPixmap, LazyImage, pickLevel
+
+# Payload content is reused when the same image and compression level come back (e.g. slider moves)
+payloadCache = Steganography.PayloadCache()
+
+# Decoding, payload building, embedding, extraction and cleaning run here instead of on the GUI thread
+workers = WorkerPool()
+
+# Milliseconds the compression slider has to rest before the payload is prebuilt for its level
+PREBUILD_DELAY = 400
+
+
+# The jobs below get the dropped images as LazyImage, so full resolution arrays are only decoded (on the worker
+# pool) by the operations that need them
+
+
+def buildPayload(image, compressionLevel):
+    return payloadCache.get(image.array(), compressionLevel)
+
+
+def payloadSizes(image):
+    return Steganography.contentSizes(image.array())
+
+
+def probeCarrier(image):
+    # PNG carriers are checked from their first pixels only
+    if image.path.lower().endswith(".png"):
+        return Steganography.payloadExistsInFile(image.path)
+
+    return Steganography.Carrier(image.array()).payloadExists()
+
+
+def embedAndSave(carrierImage, payloadImage, compressionLevel, override, path):
+    # The payload is usually prebuilt (and cached) by the time the save button is pressed
+    payload = buildPayload(payloadImage, compressionLevel)
+    imsave(path, Steganography.Carrier(carrierImage.array()).embedPayload(payload, override=override))
+
+    return path
+
+
+def extractPayload(image):
+    return Steganography.Carrier(image.array()).extractPayload()
+
+
+def cleanAndSave(image, path):
+    imsave(path, Steganography.Carrier(image.array()).clean())
+
+    return path
 
 class Displays(QGraphicsView):
     newpic = Signal(str)
+
+    # The dropped image and its preview pyramid (largest level first)
+    image = None
+    pyramid = None
+
     def __init_(self, title, parent):
         super(Displays, self).__init__(title, parent)
 
@@ -22,16 +75,26 @@ class Displays(QGraphicsView):
     def dropEvent(self, event):
         ext = event.mimeData().text()[-5:-2]
         if ext == "png" or ext == "jpg" or ext == "PEG":
-            scene = QtGui.QGraphicsScene()
-            pixMap = QtGui.QPixmap(event.mimeData().text()[7:-2])
-            PixItem = scene.addPixmap(pixMap)
-            self.setScene(scene)
-            self.fitInView(PixItem, Qt.KeepAspectRatio)
-            self.show()
-
+            # Only a reduced preview is decoded (on the worker pool); newpic is emitted once it has arrived
             self.name = event.mimeData().text()[7:-2]
-            self.imgArr = imread(self.name)
-            self.newpic.emit('signal')
+            self.image = LazyImage(self.name)
+            workers.submit("preview " + self.objectName(), self.image.pyramid)
+
+    def showPreview(self):
+        # Show the smallest pyramid level that still fills the view
+        if self.pyramid is None:
+            return
+
+        scene = QtGui.QGraphicsScene()
+        pixMap = toQPixmap(pickLevel(self.pyramid, self.viewport().width(), self.viewport().height()))
+        PixItem = scene.addPixmap(pixMap)
+        self.setScene(scene)
+        self.fitInView(PixItem, Qt.KeepAspectRatio)
+        self.show()
+
+    def resizeEvent(self, event):
+        super(Displays, self).resizeEvent(event)
+        self.showPreview()
 
     def dragMoveEvent(self, event):
         event.accept()
@@ -52,35 +115,53 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         self.applyCompressVal = self.chkApplyCompression.isChecked()
         self.compressionLevelVal = -1
         self.payloadSizeVal = 0
+        self.payloadSizes = {}
         self.payload1InPlace = False
-        self.pay1Img = None
+        self.pay1Image = None
         self.payload1 = None
 
         self.applyOverrideVal = self.chkOverride.isChecked()
         self.carrierSizeVal = 0
         self.existsPayload = False
         self.carrier1InPlace = False
-        self.car1Img = None
-        self.carrier1 = None
+        self.car1Image = None
 
         self.extractPay = False
         self.cleanCar = False
         self.existsPayload2 = False
         self.carrier2InPlace = False
-        self.car2Img = None
-        self.carrier2 = None
+        self.car2Image = None
 
         # Functions for sliders and check boxes
         self.chkApplyCompression.stateChanged.connect(self.compressChk)
         self.slideCompression.valueChanged.connect(self.updateCompressVal)
         self.slideCompression.setTickInterval(0)
 
+        # Slider moves only look sizes up; the payload is prebuilt once the slider settles
+        self.prebuildTimer = QTimer(self)
+        self.prebuildTimer.setSingleShot(True)
+        self.prebuildTimer.setInterval(PREBUILD_DELAY)
+        self.prebuildTimer.timeout.connect(self.prebuildPayload)
+
         self.chkOverride.stateChanged.connect(self.overrideChk)
         self.btnSave.clicked.connect(self.startSaveProcess)
 
+        # Every save is a job of its own, so that a second save does not supersede the first
+        self.saveCount = 0
+
+        # Stops whatever the worker pool is doing
+        self.btnCancel = QPushButton("Cancel", self)
+        self.btnCancel.clicked.connect(self.cancelJobs)
+        self.statusbar.addPermanentWidget(self.btnCancel)
+
         self.btnExtract.clicked.connect(self.startExtractProcess)
         self.btnClean.clicked.connect(self.startCleanProcess)
 
+        # Results of the worker pool come back on the GUI thread
+        workers.signals.progress.connect(self.jobProgress)
+        workers.signals.finished.connect(self.jobFinished)
+        workers.signals.failed.connect(self.jobFailed)
+
         # Embed payload --> Payload
         self.viewPayload1 = Displays(self.grpPayload1, self)
         self.viewPayload1.setGeometry(QtCore.QRect(10, 40, 361, 281))
@@ -99,6 +180,41 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         self.viewCarrier2.setObjectName("viewCarrier2")
         self.viewCarrier2.newpic.connect(self.newCarrier2)
 
+    def cancelJobs(self):
+        workers.cancelAll()
+        self.statusbar.showMessage("Cancelled", 2000)
+
+    def closeEvent(self, event):
+        # Background work is dropped on close; saves and cleans that were asked for still finish
+        workers.cancelAll(keep=("save", "clean"))
+        super(SteganographyConsumer, self).closeEvent(event)
+
+    def jobProgress(self, key, stage, size):
+        self.statusbar.showMessage("{}: {} done".format(key, stage))
+
+    def jobFailed(self, key, message):
+        self.statusbar.showMessage("{} failed: {}".format(key, message))
+
+    def jobFinished(self, key, result):
+        self.statusbar.showMessage("{} done".format(key), 2000)
+
+        if key.startswith("preview "):
+            view = getattr(self, key[len("preview "):])
+            view.pyramid = result
+            view.showPreview()
+            view.newpic.emit('signal')
+        elif key == "carrier1":
+            self.showCarrier1Payload(result)
+        elif key == "carrier2":
+            self.showCarrier2Payload(result)
+        elif key == "sizes":
+            self.payloadSizes = result
+            self.updateCompressionTextBox()
+        elif key == "extract":
+            self.showExtractedPayload(result)
+        elif key == "clean":
+            self.lblCarrierEmpty.setText(">>>> Carrier Empty <<<<")
+
     def newpayload1(self):
         print("Payload 1")
         self.payload1InPlace = True
@@ -108,12 +224,30 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         self.txtCompression.setText('0')
         self.slideCompression.setSliderPosition(0)
 
-        self.pay1Img = self.viewPayload1.imgArr
+        self.pay1Image = self.viewPayload1.image
+
+        # Work out the size for every compression level at once, so slider moves are only lookups
+        self.payloadSizes = {}
+        workers.submit("sizes", payloadSizes, self.pay1Image)
         self.updateCompressionTextBox()
 
+    def prebuildPayload(self):
+        # Building the payload ahead of time makes saving quicker; saving builds it anyway if it is not ready
+        if self.pay1Image is not None:
+            workers.submit("payload", buildPayload, self.pay1Image, self.compressionLevelVal)
+
     def updateCompressionTextBox(self):
-        self.payload1 = Steganography.Payload(img=self.pay1Img, compressionLevel=self.compressionLevelVal)
-        self.payloadSizeVal = len(self.payload1.content)
+        # Restarting the timer on every tick defers the prebuild until the slider rests
+        self.payload1 = None
+        self.prebuildTimer.start()
+
+        if self.compressionLevelVal not in self.payloadSizes:
+            self.payloadSizeVal = None
+            self.txtPayloadSize.setText("...")
+            self.btnSave.setEnabled(False)
+            return
+
+        self.payloadSizeVal = self.payloadSizes[self.compressionLevelVal]
         self.txtPayloadSize.setText(str(self.payloadSizeVal))
 
         self.checkSaveBtnConds()
@@ -150,10 +284,22 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         print("Carrier1")
         self.carrier1InPlace = True
 
-        self.car1Img = self.viewCarrier1.imgArr
-        self.carrier1 = Steganography.Carrier(img=self.car1Img)
+        self.car1Image = self.viewCarrier1.image
+
+        # Saving waits until the carrier has been checked for a payload
+        self.existsPayload = None
+        workers.submit("carrier1", probeCarrier, self.car1Image)
+
+        # Measured in symbols like the payload size: gray carriers hold a symbol in every 3 pixels, not in every pixel
+        self.carrierSizeVal = (self.car1Image.shape[0] * self.car1Image.shape[1] *
+                               (self.car1Image.shape[2] if len(self.car1Image.shape) == 3 else 1)) // 3
+
+        self.txtCarrierSize.setText(str(self.carrierSizeVal))
+
+        self.checkSaveBtnConds()
 
-        self.existsPayload = self.carrier1.payloadExists()
+    def showCarrier1Payload(self, existsPayload):
+        self.existsPayload = existsPayload
 
         if self.existsPayload:
             self.chkOverride.setEnabled(True)
@@ -162,13 +308,6 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
             self.chkOverride.setEnabled(False)
             self.lblPayloadFound.setText("")
 
-        if len(self.carrier1.img.shape) == 3:
-            self.carrierSizeVal = self.carrier1.img.shape[0] * self.carrier1.img.shape[1]
-        else:
-            self.carrierSizeVal = self.carrier1.img.size
-
-        self.txtCarrierSize.setText(str(self.carrierSizeVal))
-
         self.checkSaveBtnConds()
 
     def overrideChk(self):
@@ -178,7 +317,7 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         self.checkSaveBtnConds()
 
     def checkSaveBtnConds(self):
-        if self.carrier1InPlace and self.payload1InPlace:
+        if self.carrier1InPlace and self.payload1InPlace and self.payloadSizeVal is not None:
             print("Both in place")
             if self.carrierSizeVal >= self.payloadSizeVal:
                 print(self.carrierSizeVal, self.payloadSizeVal)
@@ -196,9 +335,12 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
     def startSaveProcess(self):
         print("Save btn pushed")
         (path, _) = QFileDialog.getSaveFileName(self, 'Save Image...')
+        if not path:
+            return
 
-        embeddedArr = self.carrier1.embedPayload(self.payload1, override=self.applyOverrideVal)
-        imsave(path, embeddedArr)
+        self.saveCount += 1
+        workers.submit("save %d" % self.saveCount, embedAndSave, self.car1Image, self.pay1Image,
+                       self.compressionLevelVal, self.applyOverrideVal, path)
 
     def newCarrier2(self):
         print("Carrier2")
@@ -209,10 +351,14 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         self.viewPayload2.setScene(scene)
         self.viewPayload2.show()
 
-        self.car2Img = self.viewCarrier2.imgArr
-        self.carrier2 = Steganography.Carrier(img=self.car2Img)
+        self.car2Image = self.viewCarrier2.image
 
-        self.existsPayload2 = self.carrier2.payloadExists()
+        self.btnExtract.setEnabled(False)
+        self.btnClean.setEnabled(False)
+        workers.submit("carrier2", probeCarrier, self.car2Image)
+
+    def showCarrier2Payload(self, existsPayload):
+        self.existsPayload2 = existsPayload
 
         if self.existsPayload2:
             self.btnExtract.setEnabled(True)
@@ -225,22 +371,23 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
 
     def startExtractProcess(self):
         print("Extract Image")
-        payload = self.carrier2.extractPayload()
+        workers.submit("extract", extractPayload, self.car2Image)
 
+        self.btnExtract.setEnabled(False)
+
+    def showExtractedPayload(self, payload):
+        # The pixmap is built straight from the array, nothing is written to disk
         scene = QtGui.QGraphicsScene()
-        imsave('temp.png', payload.img)
-        pixMap = QtGui.QPixmap('temp.png')
+        pixMap = toQPixmap(payload.img)
         PixItem = scene.addPixmap(pixMap)
         self.viewPayload2.setScene(scene)
         self.viewPayload2.fitInView(PixItem,  Qt.KeepAspectRatio)
         self.viewPayload2.show()
 
-        self.btnExtract.setEnabled(False)
-
     def startCleanProcess(self):
         print("Clean Image")
         # print(self.viewCarrier2.name)
-        cleanImg = self.carrier2.clean()
+        workers.submit("clean", cleanAndSave, self.car2Image, self.viewCarrier2.name)
 
         scene = QtGui.QGraphicsScene()
         scene.clear()
@@ -248,11 +395,9 @@ class SteganographyConsumer(QMainWindow, Ui_MainWindow):
         self.viewPayload2.show()
 
         # scene = QtGui.QGraphicsScene()
-        imsave(self.viewCarrier2.name, cleanImg)
         # pixMap = QtGui.QPixmap(self.viewCarrier2.name)
         # PixItem = scene.addPixmap(pixMap)
 
-        self.lblCarrierEmpty.setText(">>>> Carrier Empty <<<<")
         # self.viewPayload2.setScene(scene)
         # self.viewPayload2.fitInView(PixItem,  Qt.KeepAspectRatio)
         # self.viewPayload2.show()
@@ -263,4 +408,5 @@ currentApp = QApplication(sys.argv)
 currentForm = SteganographyConsumer()
 
 currentForm.show()
-currentApp.exec_()
\ No newline at end of file
+currentApp.exec_()
+workers.waitForDone()
\ No newline at end of file
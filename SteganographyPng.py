@@ -0,0 +1,297 @@
+import io
+import struct
+import zlib
+import numpy as np
+
+# Pillow (already needed by scipy.misc.imread) undoes the Average and Paeth filters in C; without it they are
+# undone in Python
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Number of samples per pixel for every PNG colour type (palette images are not handled)
+PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+class UnsupportedPng(ValueError):
+    pass
+
+
+def readChunks(pngFile):
+    # Yields the (type, data) of every chunk, stopping after IEND
+    if pngFile.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise UnsupportedPng("Not a PNG file.")
+
+    while True:
+        head = pngFile.read(8)
+        if len(head) < 8:
+            raise UnsupportedPng("The PNG file is truncated.")
+
+        (length, chunkType) = struct.unpack(">I4s", head)
+        data = pngFile.read(length)
+        pngFile.read(4)
+
+        yield chunkType, data
+
+        if chunkType == b"IEND":
+            return
+
+
+def parseHeader(data):
+    # Returns (width, height, channels) of an IHDR chunk with the layouts that are supported
+    (width, height, bitDepth, colorType, compression, filterMethod, interlace) = struct.unpack(">IIBBBBB", data)
+
+    if bitDepth != 8 or colorType not in PNG_CHANNELS or interlace != 0:
+        raise UnsupportedPng("Only non-interlaced 8-bit gray, gray alpha, RGB and RGBA PNG files are supported.")
+
+    return width, height, PNG_CHANNELS[colorType]
+
+
+def unfilterRow(filterType, row, prior, bpp):
+    # Undo the PNG filter of one scanline (row and prior are uint8 arrays, prior is zeros for the first row)
+    if filterType == 0:
+        return row
+    if filterType == 1:
+        return (np.cumsum(row.reshape(-1, bpp), axis=0, dtype=np.uint64) & 0xFF).astype(np.uint8).reshape(-1)
+    if filterType == 2:
+        return row + prior
+
+    # Average and Paeth depend on the previous reconstructed byte, so they are undone byte by byte (on Python
+    # lists, which index much faster than numpy scalars)
+    out = [0] * (row.size + bpp)
+    (row, prior) = (row.tolist(), [0] * bpp + prior.tolist())
+
+    for i in range(len(row)):
+        (a, b, c) = (out[i], prior[i + bpp], prior[i])
+
+        if filterType == 3:
+            out[i + bpp] = (row[i] + (a + b) // 2) & 0xFF
+        elif filterType == 4:
+            (pa, pb, pc) = (abs(b - c), abs(a - c), abs(a + b - 2 * c))
+            predictor = a if pa <= pb and pa <= pc else (b if pb <= pc else c)
+            out[i + bpp] = (row[i] + predictor) & 0xFF
+        else:
+            raise UnsupportedPng("Unknown PNG filter type %d." % filterType)
+
+    return np.array(out[bpp:], dtype=np.uint8)
+
+
+def filterRows(filterType, rows, prior, bpp):
+    # Apply a PNG filter to a block of scanlines (rows is a 2-d uint8 array, prior the scanline before the block)
+    if filterType == 0:
+        return rows
+    if filterType == 1:
+        return rows - np.pad(rows, ((0, 0), (bpp, 0)))[:, :-bpp]
+    if filterType == 2:
+        return rows - np.vstack([prior[np.newaxis], rows[:-1]])
+
+    raise UnsupportedPng("Only the None, Sub and Up filters are written.")
+
+
+class PngReader:
+    # Decodes a PNG file a block of rows at a time. Only as much of the IDAT stream is inflated as the requested
+    # rows need, so memory is bounded by the block, whatever the size of the image.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.chunks = readChunks(self.file)
+
+        # The file is closed when the header cannot be read, since the caller never gets the reader to close
+        try:
+            (chunkType, data) = next(self.chunks)
+            if chunkType != b"IHDR":
+                raise UnsupportedPng("The PNG file does not start with IHDR.")
+
+            (self.width, self.height, self.channels) = parseHeader(data)
+        except Exception:
+            self.file.close()
+            raise
+
+        self.rowsRead = 0
+        self.prior = np.zeros(self.width * self.channels, dtype=np.uint8)
+        self.pending = bytearray()
+        self.tail = b""
+        self.decompressor = zlib.decompressobj()
+
+    @property
+    def shape(self):
+        return (self.height, self.width, self.channels) if self.channels > 1 else (self.height, self.width)
+
+    def nextData(self):
+        for (chunkType, data) in self.chunks:
+            if chunkType == b"IDAT":
+                return data
+
+        raise UnsupportedPng("The PNG image data is truncated.")
+
+    def readRows(self, count):
+        # Returns the next (at most) count rows, shaped like the image
+        count = min(count, self.height - self.rowsRead)
+        rowBytes = 1 + self.prior.size
+        needed = count * rowBytes
+
+        while len(self.pending) < needed:
+            if not self.tail:
+                self.tail = self.nextData()
+
+            self.pending += self.decompressor.decompress(self.tail, needed - len(self.pending))
+            self.tail = self.decompressor.unconsumed_tail
+
+        scanlines = np.frombuffer(bytes(self.pending[:needed]), dtype=np.uint8).reshape(count, rowBytes)
+        del self.pending[:needed]
+
+        if Image is not None and count and scanlines[:, 0].max() > 2:
+            rows = self.decodeBand(scanlines)
+            self.prior = rows[-1].copy()
+        else:
+            rows = np.empty((count, self.prior.size), dtype=np.uint8)
+            for (i, scanline) in enumerate(scanlines):
+                rows[i] = self.prior = unfilterRow(scanline[0], scanline[1:], self.prior, self.channels)
+
+        self.rowsRead += count
+
+        return rows.reshape((count, ) + self.shape[1:])
+
+    def decodeBand(self, scanlines):
+        # Wraps the band, after an unfiltered copy of the row before it, in a stored (uncompressed) PNG of its own
+        # and lets Pillow undo the filters
+        colorTypes = {channels: colorType for (colorType, channels) in PNG_CHANNELS.items()}
+        data = np.vstack([np.concatenate([np.zeros(1, dtype=np.uint8), self.prior]), scanlines])
+
+        band = io.BytesIO()
+        band.write(PNG_SIGNATURE)
+        for (chunkType, chunk) in [(b"IHDR", struct.pack(">IIBBBBB", self.width, len(data), 8,
+                                                        colorTypes[self.channels], 0, 0, 0)),
+                                   (b"IDAT", zlib.compress(data, 0)), (b"IEND", b"")]:
+            band.write(struct.pack(">I", len(chunk)) + chunkType + chunk)
+            band.write(struct.pack(">I", zlib.crc32(chunk, zlib.crc32(chunkType)) & 0xFFFFFFFF))
+
+        band.seek(0)
+        with Image.open(band) as img:
+            return np.array(img).reshape(len(data), -1)[1:]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+class PngWriter:
+    # Encodes a PNG file a block of rows at a time: rows are filtered and deflated as they are written, and IDAT
+    # chunks are written out once chunkSize compressed bytes have accumulated, so only that much is held in memory
+    def __init__(self, path, width, height, channels, bitDepth=8, level=6, filterType=1, chunkSize=1 << 16):
+        colorTypes = {channels: colorType for (colorType, channels) in PNG_CHANNELS.items()}
+
+        if channels not in colorTypes or bitDepth not in (8, 16):
+            raise UnsupportedPng("Only 8 and 16-bit gray, gray alpha, RGB and RGBA PNG files are written.")
+
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(">u2") if bitDepth == 16 else np.dtype(np.uint8)
+        self.bpp = channels * self.dtype.itemsize
+        self.filterType = filterType
+        self.chunkSize = chunkSize
+
+        self.rowsWritten = 0
+        self.prior = np.zeros(width * self.bpp, dtype=np.uint8)
+        self.pending = bytearray()
+        self.compressor = zlib.compressobj(level)
+
+        self.file = open(path, "wb")
+        self.file.write(PNG_SIGNATURE)
+        self.writeChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bitDepth, colorTypes[channels], 0, 0, 0))
+
+    def writeChunk(self, chunkType, data):
+        self.file.write(struct.pack(">I", len(data)) + chunkType)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunkType)) & 0xFFFFFFFF))
+
+    def writeRows(self, rows):
+        # rows has shape (count, width) or (count, width, channels)
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(len(rows), -1).view(np.uint8)
+
+        if rows.shape[1] != self.prior.size:
+            raise ValueError("The rows do not match the width of the image.")
+        if self.rowsWritten + len(rows) > self.height:
+            raise ValueError("More rows were written than the image holds.")
+        if len(rows) == 0:
+            return
+
+        filtered = filterRows(self.filterType, rows, self.prior, self.bpp)
+        scanlines = np.hstack([np.full((len(rows), 1), self.filterType, dtype=np.uint8), filtered])
+
+        self.pending += self.compressor.compress(scanlines)
+        self.prior = rows[-1].copy()
+        self.rowsWritten += len(rows)
+
+        if len(self.pending) >= self.chunkSize:
+            self.writeChunk(b"IDAT", self.pending)
+            self.pending.clear()
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        try:
+            if self.rowsWritten != self.height:
+                raise ValueError("Only %d of %d rows were written." % (self.rowsWritten, self.height))
+
+            self.pending += self.compressor.flush()
+            self.writeChunk(b"IDAT", self.pending)
+            self.writeChunk(b"IEND", b"")
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # A failed write leaves the partial file behind, without raising a second error over the first
+        if excType is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def readLeadingPixels(path, count=None, values=None):
+    # Inflates only enough of the IDAT stream to recover the first count pixels of the first scanline, or (given
+    # values instead) the fewest pixels that cover that many channel values. Returns an array of shape
+    # (pixels, channels), or (pixels,) for gray images.
+    with open(path, "rb") as pngFile:
+        chunks = readChunks(pngFile)
+        (chunkType, data) = next(chunks)
+
+        if chunkType != b"IHDR":
+            raise UnsupportedPng("The PNG file does not start with IHDR.")
+
+        (width, height, channels) = parseHeader(data)
+        if count is None:
+            count = -(-values // channels)
+
+        if width < count:
+            raise UnsupportedPng("The image is narrower than the requested pixels.")
+
+        # The filter type byte, followed by the pixels
+        needed = 1 + count * channels
+        decompressor = zlib.decompressobj()
+        scanline = b""
+
+        for (chunkType, data) in chunks:
+            if chunkType == b"IDAT":
+                scanline += decompressor.decompress(data, needed - len(scanline))
+
+                if len(scanline) >= needed:
+                    break
+        else:
+            raise UnsupportedPng("The PNG image data is truncated.")
+
+    row = np.frombuffer(scanline[1:needed], dtype=np.uint8)
+    pixels = unfilterRow(scanline[0], row, np.zeros_like(row), channels)
+
+    return pixels.reshape(count, channels) if channels > 1 else pixels
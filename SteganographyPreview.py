@@ -0,0 +1,161 @@
+import threading
+import numpy as np
+from PIL import Image
+from PySide.QtGui import QImage, QPixmap, qRgb
+from scipy.misc import imread
+
+from SteganographyPng import PngReader, UnsupportedPng
+
+# Gray images are shown as 8-bit indexed images with an identity gray palette
+GRAY_TABLE = [qRgb(value, value, value) for value in range(256)]
+
+# Pillow modes that are read as they are; images in other modes are converted to 8-bit gray or RGB(A) first
+NATIVE_MODES = ("L", "LA", "RGB", "RGBA", "I;16")
+
+# Longest side of the largest and of the smallest preview pyramid level
+PREVIEW_SIZE = 2048
+MIN_PREVIEW_SIZE = 128
+
+
+def readMode(img):
+    # The mode a Pillow image is read in, so that palette, 1-bit, CMYK, ... images are shown with their colors
+    if img.mode in NATIVE_MODES:
+        return img.mode
+    if img.mode in ("1", "I", "F"):
+        return "L"
+
+    return "RGBA" if img.mode == "PA" or "transparency" in img.info else "RGB"
+
+
+def displayable(arr):
+    # Reduce an image to 8-bit gray or RGB, the two layouts the bridge hands to Qt
+    if arr.dtype == np.uint16:
+        arr = (arr >> 8).astype(np.uint8)
+    elif arr.dtype != np.uint8:
+        arr = arr.astype(np.uint8)
+
+    # Alpha is dropped: gray alpha images become gray, RGBA images become RGB
+    if arr.ndim == 3 and arr.shape[2] in (1, 2):
+        arr = arr[:, :, 0]
+    elif arr.ndim == 3 and arr.shape[2] != 3:
+        arr = arr[:, :, :3]
+
+    return arr
+
+
+def rowBuffer(arr):
+    # The memory holding the rows of arr as one flat uint8 array, or None when the rows are not packed pixels
+    # (then the image has to be copied). Rows may be spaced further apart than their length, e.g. for a crop.
+    (rows, cols) = arr.shape[:2]
+    pixelBytes = 3 if arr.ndim == 3 else 1
+
+    if arr.strides[-1] != 1 or (arr.ndim == 3 and arr.strides[1] != 3) or arr.strides[0] < cols * pixelBytes:
+        return None
+
+    span = (rows - 1) * arr.strides[0] + cols * pixelBytes
+
+    return np.lib.stride_tricks.as_strided(arr, shape=(span, ), strides=(1, ))
+
+
+def toQImage(arr):
+    # Wraps a gray (rows, cols) or RGB (rows, cols, 3) array in a QImage without copying it when the strides allow.
+    # The QImage does not own the memory, so the array is kept alive on it.
+    arr = displayable(arr)
+    buffer = rowBuffer(arr)
+
+    if buffer is None:
+        arr = np.ascontiguousarray(arr)
+        buffer = arr.reshape(-1)
+
+    (rows, cols) = arr.shape[:2]
+    imageFormat = QImage.Format_RGB888 if arr.ndim == 3 else QImage.Format_Indexed8
+
+    image = QImage(buffer.data, cols, rows, arr.strides[0], imageFormat)
+    if arr.ndim == 2:
+        image.setColorTable(GRAY_TABLE)
+
+    image.ndarray = buffer
+
+    return image
+
+
+def toQPixmap(arr):
+    # The pixmap holds its own copy of the pixels, so the array is free once it is built
+    return QPixmap.fromImage(toQImage(arr))
+
+
+def halve(arr):
+    # Average every 2x2 block (of an 8-bit image)
+    (rows, cols) = (arr.shape[0] // 2 * 2, arr.shape[1] // 2 * 2)
+    wide = arr[:rows, :cols].astype(np.uint16)
+
+    return ((wide[0::2, 0::2] + wide[1::2, 0::2] + wide[0::2, 1::2] + wide[1::2, 1::2] + 2) // 4).astype(np.uint8)
+
+
+class LazyImage:
+    # An image file whose full resolution array is only decoded when an operation asks for it (once, on whichever
+    # thread asks first). Its shape and reduced previews are available without it.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.arr = None
+
+        # Only the header is read here
+        with Image.open(path) as img:
+            bands = Image.getmodebands(readMode(img))
+            self.shape = (img.height, img.width) + ((bands, ) if bands > 1 else ())
+
+    def array(self):
+        with self.lock:
+            if self.arr is None:
+                self.arr = imread(self.path)
+
+            return self.arr
+
+    def preview(self, maxSide=PREVIEW_SIZE):
+        # Every step-th row and column, without decoding the full image into memory when it is not loaded yet
+        step = -(-max(self.shape[:2]) // maxSide)
+
+        if self.arr is not None:
+            return self.arr[::step, ::step]
+
+        # PNG files are decoded a band of rows at a time and only the kept rows are held
+        try:
+            with PngReader(self.path) as reader:
+                bands = []
+
+                while reader.rowsRead < reader.height:
+                    bands.append(reader.readRows(step * max(1, 256 // step))[::step, ::step].copy())
+
+                return np.concatenate(bands)
+        except UnsupportedPng:
+            pass
+
+        # JPEG files are decoded straight at a reduced scale, other formats (and PNG layouts the reader does not
+        # handle) are decoded whole
+        with Image.open(self.path) as img:
+            img.draft(img.mode, (self.shape[1] // step, self.shape[0] // step))
+            mode = readMode(img)
+            arr = np.asarray(img if img.mode == mode else img.convert(mode))
+
+        step = -(-max(arr.shape[:2]) // maxSide)
+
+        return arr[::step, ::step]
+
+    def pyramid(self, maxSide=PREVIEW_SIZE, minSide=MIN_PREVIEW_SIZE):
+        # The preview and its successive halvings, largest first
+        levels = [displayable(self.preview(maxSide))]
+
+        while max(levels[-1].shape[:2]) // 2 >= minSide:
+            levels.append(halve(levels[-1]))
+
+        return levels
+
+
+def pickLevel(pyramid, width, height):
+    # The smallest level that still covers width x height pixels (the largest one when none does)
+    for level in reversed(pyramid):
+        if level.shape[1] >= width and level.shape[0] >= height:
+            return level
+
+    return pyramid[0]
@@ -0,0 +1,132 @@
+import threading
+from PySide.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+import Steganography
+
+
+class Cancelled(Exception):
+    pass
+
+
+class WorkerSignals(QObject):
+    # Emitted from the pool threads; the receiving widgets live on the GUI thread, so Qt queues the calls there
+    progress = Signal(str, str, object)
+    finished = Signal(str, object)
+    failed = Signal(str, str)
+
+
+class Job(QRunnable):
+    def __init__(self, pool, key, func, args, kwargs):
+        super(Job, self).__init__()
+
+        self.pool = pool
+        self.key = key
+        (self.func, self.args, self.kwargs) = (func, args, kwargs)
+        self.cancelled = False
+
+    def run(self):
+        # Jobs that were superseded while they were queued never start
+        if self.cancelled:
+            return
+
+        self.pool.started(self)
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Cancelled:
+            return
+        except Exception as error:
+            if self.pool.retire(self):
+                self.pool.signals.failed.emit(self.key, str(error))
+            return
+        finally:
+            self.pool.stopped(self)
+
+        # Results of jobs that were superseded while they ran are dropped
+        if self.pool.retire(self):
+            self.pool.signals.finished.emit(self.key, result)
+
+
+class WorkerPool:
+    # Runs GUI work on a QThreadPool. Jobs are submitted under a key and only the latest job of every key counts:
+    # submitting again cancels the previous one, so rapid slider moves or drops only deliver the last result.
+    # The library's trace spans act as checkpoints: every finished stage reports progress, and a cancelled job
+    # stops at its next stage.
+    def __init__(self, maxThreads=None):
+        self.threadPool = QThreadPool()
+        if maxThreads:
+            self.threadPool.setMaxThreadCount(maxThreads)
+
+        self.signals = WorkerSignals()
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.running = {}
+
+    def submit(self, key, func, *args, **kwargs):
+        with self.lock:
+            previous = self.latest.get(key)
+            if previous is not None:
+                previous.cancelled = True
+
+            job = Job(self, key, func, args, kwargs)
+            self.latest[key] = job
+
+        self.threadPool.start(job)
+
+        return job
+
+    def cancel(self, key):
+        with self.lock:
+            job = self.latest.pop(key, None)
+
+        if job is not None:
+            job.cancelled = True
+
+    def cancelAll(self, keep=()):
+        # Cancels the latest job of every key, except keys starting with one of the keep prefixes
+        with self.lock:
+            keys = [key for key in self.latest if not key.startswith(tuple(keep))]
+            jobs = [self.latest.pop(key) for key in keys]
+
+        for job in jobs:
+            job.cancelled = True
+
+    def isCurrent(self, job):
+        with self.lock:
+            return self.latest.get(job.key) is job and not job.cancelled
+
+    def retire(self, job):
+        # Forgets a job that has ended (releasing its arguments); returns whether its result still counts
+        with self.lock:
+            current = self.latest.get(job.key) is job and not job.cancelled
+            if current:
+                del self.latest[job.key]
+
+            return current
+
+    def started(self, job):
+        with self.lock:
+            self.running[threading.get_ident()] = job
+
+            # Spans are only timed while some job is running
+            if len(self.running) == 1:
+                Steganography.addTraceHook(self.checkpoint)
+
+    def stopped(self, job):
+        with self.lock:
+            del self.running[threading.get_ident()]
+
+            if not self.running:
+                Steganography.removeTraceHook(self.checkpoint)
+
+    def checkpoint(self, name, start, duration, size, thread):
+        job = self.running.get(thread)
+        if job is None:
+            return
+
+        if job.cancelled:
+            raise Cancelled()
+
+        self.signals.progress.emit(job.key, name, size)
+
+    def waitForDone(self):
+        self.threadPool.waitForDone()
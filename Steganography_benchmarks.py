@@ -0,0 +1,323 @@
+import sys
+import time
+import json
+import zlib
+import base64
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from scipy.misc import imread
+from Steganography import *
+
+
+def legacyEncode(data):
+    # The previous path: base64 encode, then map every character through a dict with np.vectorize
+    table = {c: i for (i, c) in enumerate(RADIX64_ALPHABET)}
+    encoded = list(base64.b64encode(data).rstrip(b"="))
+
+    return np.array(np.vectorize(table.get)(np.array(encoded)), dtype=np.uint8)
+
+
+def legacyDecode(symbols):
+    # The previous path: map every symbol to a character with np.vectorize, join the string, base64 decode
+    table = {i: chr(c) for (i, c) in enumerate(RADIX64_ALPHABET)}
+    chars = "".join(map(str, list(np.vectorize(table.get)(np.array(symbols)).flat)))
+    chars += "=" * ((-len(chars)) % 4)
+
+    return base64.b64decode(chars)
+
+
+def legacyGrayExtract(img, count):
+    # The previous gray path: a Python tuple per symbol from zipping three strided slices of the flattened image
+    flat = img.reshape(-1)[:count * 3]
+    list2d = np.array(list(zip(flat[::3], flat[1::3], flat[2::3])))
+
+    return ((list2d & 0b11) << np.array([0, 2, 4])).sum(axis=1).astype(np.uint8)
+
+
+def timeIt(func, *args, repeat=3):
+    best = None
+
+    for iteration in range(repeat):
+        begin = time.perf_counter()
+        result = func(*args)
+        end = time.perf_counter()
+
+        best = end - begin if best is None else min(best, end - begin)
+
+    return best, result
+
+
+def benchmarkCodec(sizes=(10 ** 4, 10 ** 5, 10 ** 6)):
+    rng = np.random.RandomState(0)
+
+    print("{:>10} | {:>12} {:>12} {:>8} | {:>12} {:>12} {:>8}".format(
+        "bytes", "legacy enc", "encode6Bit", "speedup", "legacy dec", "decode6Bit", "speedup"))
+
+    for size in sizes:
+        data = rng.randint(0, 256, size).astype(np.uint8).tobytes()
+
+        (legacyEnc, legacySymbols) = timeIt(legacyEncode, data)
+        (newEnc, symbols) = timeIt(encode6Bit, data)
+        (legacyDec, legacyData) = timeIt(legacyDecode, symbols)
+        (newDec, newData) = timeIt(decode6Bit, symbols)
+
+        if not np.array_equal(legacySymbols, symbols) or legacyData != newData.tobytes():
+            raise AssertionError("The codec output does not match the legacy path.")
+
+        print("{:>10} | {:>10.4f} s {:>10.4f} s {:>7.1f}x | {:>10.4f} s {:>10.4f} s {:>7.1f}x".format(
+            size, legacyEnc, newEnc, legacyEnc / newEnc, legacyDec, newDec, legacyDec / newDec))
+
+
+def benchmarkCompression(paths=("payload1.png", "payload2.png"), levels=(1, 6, 9)):
+    # Throughput and ratio of every registered compression codec on the raster scan of the bundled payloads
+    print("{:<14} {:>6} {:>5} | {:>10} {:>8} | {:>12} {:>12}".format(
+        "payload", "codec", "level", "bytes", "ratio", "compress", "decompress"))
+
+    for path in paths:
+        fullImg = rasterScan(imread(path))
+
+        for codec in CODECS.values():
+            if codec.name == "none":
+                continue
+
+            for level in levels:
+                (compressTime, compressed) = timeIt(codec.compress, fullImg, level)
+                (decompressTime, restored) = timeIt(inflateInto, np.frombuffer(compressed, dtype=np.uint8),
+                                                    np.empty_like(fullImg), codec.name)
+
+                if not np.array_equal(restored, fullImg):
+                    raise AssertionError("The %s codec does not round trip." % codec.name)
+
+                print("{:<14} {:>6} {:>5} | {:>10} {:>7.2f}x | {:>7.1f} MB/s {:>7.1f} MB/s".format(
+                    path, codec.name, level, len(compressed), fullImg.size / len(compressed),
+                    fullImg.size / 1e6 / compressTime, fullImg.size / 1e6 / decompressTime))
+
+
+def benchmarkBlockDeflate(size=64 << 20, level=9, workerCounts=(1, 2, 4, 8)):
+    # Speedup of the block-parallel deflate codec over single-stream zlib for growing worker counts
+    data = np.random.RandomState(0).randint(0, 16, size).astype(np.uint8)
+
+    (zlibCompress, compressed) = timeIt(zlib.compress, data, level, repeat=1)
+    (zlibDecompress, restored) = timeIt(zlib.decompress, compressed, repeat=1)
+
+    print("{:>8} | {:>12} {:>8} | {:>12} {:>8}".format("workers", "deflate", "speedup", "inflate", "speedup"))
+    print("{:>8} | {:>10.3f} s {:>8} | {:>10.3f} s {:>8}".format("zlib", zlibCompress, "1.0x", zlibDecompress, "1.0x"))
+
+    for workers in workerCounts:
+        (compressTime, compressed) = timeIt(blockCompress, data, level, None, workers, repeat=1)
+        (decompressTime, restored) = timeIt(blockDecompress, compressed, workers, repeat=1)
+
+        if restored != data.tobytes():
+            raise AssertionError("The block codec does not round trip.")
+
+        print("{:>8} | {:>10.3f} s {:>7.1f}x | {:>10.3f} s {:>7.1f}x".format(
+            workers, compressTime, zlibCompress / compressTime, decompressTime, zlibDecompress / decompressTime))
+
+
+def syntheticImage(megapixels, color=True, seed=0):
+    # Deterministic image of about megapixels million pixels (4:3): smooth gradients with a little noise, so that
+    # it compresses roughly like a photograph
+    rows = max(1, int(round((megapixels * 1e6 * 3 / 4) ** 0.5)))
+    cols = max(1, int(round(megapixels * 1e6 / rows)))
+
+    (y, x) = np.ogrid[:rows, :cols]
+    noise = np.random.RandomState(seed).randint(0, 8, (rows, cols, 3) if color else (rows, cols)).astype(np.uint8)
+
+    if not color:
+        return ((x * 255 // cols + y * 255 // rows) // 2).astype(np.uint8) + noise
+
+    planes = [x * 255 // cols, y * 255 // rows, (x + y) * 255 // (rows + cols)]
+
+    return np.stack([plane.astype(np.uint8) + noise[:, :, ch] for (ch, plane) in enumerate(planes)], axis=2)
+
+
+def measureStage(func, *args, repeat=1):
+    # Best wall time of repeat runs, then one run under tracemalloc for the peak memory the stage allocates
+    (seconds, result) = timeIt(func, *args, repeat=repeat)
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak, result
+
+
+def serialize(img, body, compressionLevel, version, codec="zlib"):
+    # The bytes the payload content encodes: the XML document, or the binary header and body
+    (rows, cols) = img.shape[:2]
+    compressed = compressionLevel != -1
+
+    if version == 2:
+        codecId = getCodec(codec if compressed else "none").id
+        header = PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, 2, PAYLOAD_TYPES.index("Color" if img.ndim == 3 else "Gray"),
+                                     img.shape[2] if img.ndim == 3 else 1, 0, codecId, compressionLevel, 2, rows, cols,
+                                     body.size)
+        return np.concatenate([np.frombuffer(header, dtype=np.uint8), body])
+
+    head = xmlPayloadHead("Color" if img.ndim == 3 else "Gray", rows, cols, compressed, codec)
+
+    return np.frombuffer(head.encode() + formatCsvBody(body) + b"</payload>", dtype=np.uint8)
+
+
+def benchmarkStages(sizes=(0.1, 1, 10, 100), kinds=("Color", "Gray"), compressionLevel=6, version=1, repeat=1,
+                    codecName="zlib"):
+    # Times every stage of embedding and extracting separately on synthetic carriers of the given sizes (in
+    # megapixels). Payloads are a sixteenth of the carrier, which every format fits in uncompressed.
+    results = []
+
+    print("{:>6} {:<6} {:<13} | {:>12} {:>10} {:>10}".format("MP", "kind", "stage", "time", "MB/s", "peak MB"))
+
+    for megapixels in sizes:
+        for kind in kinds:
+            carrierImg = syntheticImage(megapixels, kind == "Color", seed=1)
+            img = syntheticImage(megapixels / 16, kind == "Color", seed=2)
+            codec = getCodec(codecName)
+
+            stages = []
+
+            def stage(name, size, func, *args):
+                (seconds, peak, result) = measureStage(func, *args, repeat=repeat)
+                stages.append((name, size, seconds, peak))
+
+                return result
+
+            fullImg = stage("raster scan", img.nbytes, rasterScan, img)
+            if compressionLevel == -1:
+                body = fullImg
+            else:
+                body = np.frombuffer(stage("compress", fullImg.nbytes, codec.compress, fullImg, compressionLevel),
+                                     dtype=np.uint8)
+
+            data = stage("serialize", body.nbytes, serialize, img, body, compressionLevel, version, codecName)
+            content = stage("6-bit encode", data.nbytes, encode6Bit, data)
+
+            payload = Payload(img, compressionLevel, content=content, version=version, codec=codecName)
+            embedded = stage("embed", content.nbytes, Carrier(carrierImg).embedPayload, payload, True)
+
+            carrier = Carrier(embedded)
+            stage("payloadExists", carrierImg.nbytes, carrier.payloadExists)
+            (count, symbols) = stage("extract", content.nbytes, carrier.locatePayload)
+            decoded = stage("6-bit decode", count, decode6Bit, symbols[:count])
+            restored = stage("reconstruct", decoded.nbytes, payload.reconstructImage, decoded)
+
+            if not np.array_equal(restored, img):
+                raise AssertionError("The %s payload does not round trip." % kind)
+
+            for (name, size, seconds, peak) in stages:
+                results.append({"megapixels": megapixels, "kind": kind, "stage": name, "version": version,
+                                "codec": codecName, "compressionLevel": compressionLevel, "bytes": int(size),
+                                "seconds": seconds, "mbPerSecond": size / 1e6 / seconds, "peakBytes": peak})
+
+                print("{:>6} {:<6} {:<13} | {:>10.4f} s {:>10.1f} {:>10.1f}".format(
+                    megapixels, kind, name, seconds, size / 1e6 / seconds, peak / 1e6))
+
+    return results
+
+
+def benchmarkGrayParity(sizes=(1, 10), repeat=3):
+    # Gray and color carriers holding the same number of values (a gray carrier has three times the pixels) should
+    # go through every carrier stage at the same throughput, since both are read as a flat run of values
+    print("{:>6} {:<14} | {:>12} {:>12} {:>8} | {:>12}".format("MP", "stage", "color", "gray", "ratio", "legacy gray"))
+
+    for megapixels in sizes:
+        colorImg = syntheticImage(megapixels, True, seed=1)
+        carriers = {"Color": colorImg, "Gray": colorImg.reshape(colorImg.shape[0], -1).copy()}
+
+        payload = Payload(syntheticImage(megapixels / 16, True, seed=2), 6)
+        timings = {}
+
+        for (kind, carrierImg) in carriers.items():
+            embedded = Carrier(carrierImg).embedPayload(payload, True)
+            carrier = Carrier(embedded)
+            count = carrier.locatePayload()[0]
+
+            timings[kind] = [("embed", timeIt(Carrier(carrierImg).embedPayload, payload, True, repeat=repeat)[0]),
+                             ("payloadExists", timeIt(carrier.payloadExists, repeat=repeat)[0]),
+                             ("readSymbols", timeIt(carrier.readSymbols, 0, count, repeat=repeat)[0]),
+                             ("clean", timeIt(carrier.clean, repeat=repeat)[0])]
+
+            if kind == "Gray":
+                (legacyTime, legacySymbols) = timeIt(legacyGrayExtract, embedded, count, repeat=1)
+
+                if not np.array_equal(legacySymbols, carrier.readSymbols(0, count)):
+                    raise AssertionError("The gray symbols do not match the legacy path.")
+
+        for ((name, colorTime), (name, grayTime)) in zip(timings["Color"], timings["Gray"]):
+            legacy = "{:>10.4f} s".format(legacyTime) if name == "readSymbols" else ""
+            print("{:>6} {:<14} | {:>10.4f} s {:>10.4f} s {:>7.2f}x | {:>12}".format(
+                megapixels, name, colorTime, grayTime, grayTime / colorTime, legacy))
+
+
+def saveResults(results, path):
+    # Results are stored along with the versions that produced them
+    info = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()}
+
+    with open(path, "w") as resultFile:
+        json.dump({"environment": info, "results": results}, resultFile, indent=1)
+
+
+def resultKey(entry):
+    # Results are only compared with the same stage run on the same configuration. Baselines saved before the
+    # configuration was recorded match nothing.
+    return tuple(entry.get(field) for field in ("megapixels", "kind", "stage", "version", "codec", "compressionLevel"))
+
+
+def compareResults(results, baselinePath, tolerance=0.25):
+    # Returns (and prints) the stages that are more than tolerance slower than in the baseline
+    with open(baselinePath) as baselineFile:
+        baseline = {resultKey(entry): entry for entry in json.load(baselineFile)["results"]}
+
+    regressions = []
+
+    for entry in results:
+        before = baseline.get(resultKey(entry))
+
+        if before is not None and entry["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(entry)
+            print("REGRESSION {:>6} MP {:<6} {:<13} (v{} {} {}): {:.4f} s -> {:.4f} s ({:+.0%})".format(
+                entry["megapixels"], entry["kind"], entry["stage"], entry["version"], entry["codec"],
+                entry["compressionLevel"], before["seconds"], entry["seconds"], entry["seconds"] / before["seconds"] - 1))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Steganography benchmarks")
+    parser.add_argument("--stages", action="store_true", help="run the per-stage suite on synthetic images")
+    parser.add_argument("--parity", action="store_true", help="compare gray and color carriers of the same size")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[0.1, 1, 10, 100], help="carrier megapixels")
+    parser.add_argument("--kinds", nargs="+", choices=("Color", "Gray"), default=["Color", "Gray"])
+    parser.add_argument("-c", "--compression", type=int, default=6, help="compression level, -1 to disable")
+    parser.add_argument("--format", type=int, choices=(1, 2), default=1, help="payload format version")
+    parser.add_argument("--codec", choices=[name for name in CODECS if name != "none"], default="zlib",
+                        help="compression codec")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per stage (the best is kept)")
+    parser.add_argument("--json", help="save the stage results to this file")
+    parser.add_argument("--baseline", help="compare the stage results with this saved run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    if args.parity:
+        benchmarkGrayParity(args.sizes, args.repeat)
+        sys.exit(0)
+
+    if not args.stages:
+        benchmarkCodec()
+        print()
+        benchmarkCompression()
+        print()
+        benchmarkBlockDeflate()
+        sys.exit(0)
+
+    results = benchmarkStages(args.sizes, args.kinds, args.compression, args.format, args.repeat, args.codec)
+
+    if args.json:
+        saveResults(results, args.json)
+
+    if args.baseline and compareResults(results, args.baseline, args.tolerance):
+        sys.exit(1)
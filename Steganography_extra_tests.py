@@ -1,4 +1,7 @@
 import time
+import base64
+import tempfile
+import os
 from os.path import join
 import unittest
 import numpy as np
@@ -6,6 +9,13 @@ from numpy import ndarray as nmat
 from scipy.misc import *
 from Steganography import *
 
+# The preview bridge needs PySide
+try:
+    from PIL import Image
+    import SteganographyPreview
+except ImportError:
+    SteganographyPreview = None
+
 class ImageAssertion:
     """
     Provides a convenience method for comparing two numpy arrays.
@@ -73,14 +83,14 @@ class SteganographyExtraTestSuite(unittest.TestCase, ImageAssertion):
         durations = []
 
         for iteration in range(5):
-            begin = time.clock()
+            begin = time.perf_counter()
             referenceArray = imread(join(self.folder, "result2_9.png"))
             p = Payload(imread(join(self.folder, "payload2.png")), 9)
             c = Carrier(imread(join(self.folder, "carrier2.png")))
             result = c.embedPayload(p)
 
             output = np.array_equal(referenceArray, result)
-            end = time.clock()
+            end = time.perf_counter()
 
             durations.append(end - begin)
 
@@ -97,7 +107,7 @@ class SteganographyExtraTestSuite(unittest.TestCase, ImageAssertion):
         durations = []
 
         for iteration in range(5):
-            begin = time.clock()
+            begin = time.perf_counter()
 
             referenceArray = imread(join(self.folder, "payload2.png"))
             c = Carrier(imread(join(self.folder, "result2_9.png")))
@@ -105,7 +115,7 @@ class SteganographyExtraTestSuite(unittest.TestCase, ImageAssertion):
 
             output = np.array_equal(referenceArray, result.img)
 
-            end = time.clock()
+            end = time.perf_counter()
 
             durations.append(end - begin)
 
@@ -133,9 +143,9 @@ class SteganographyExtraTestSuite(unittest.TestCase, ImageAssertion):
             c = Carrier(imread(join(self.folder, "result5.png")))
 
             expectedValue = imread(join(self.folder, "payload5.png"))
-            begin = time.clock()
+            begin = time.perf_counter()
             actualValue = c.extractPayloadAdvanced().img
-            end = time.clock()
+            end = time.perf_counter()
 
             duration = end - begin
             print("Variable Extraction 1 Duration = {0:2.4f} sec".format(duration))
@@ -145,15 +155,466 @@ class SteganographyExtraTestSuite(unittest.TestCase, ImageAssertion):
             c = Carrier(imread(join(self.folder, "result6.png")))
 
             expectedValue = imread(join(self.folder, "payload6.png"))
-            begin = time.clock()
+            begin = time.perf_counter()
             actualValue = c.extractPayloadAdvanced().img
-            end = time.clock()
+            end = time.perf_counter()
 
             duration = end - begin
             print("Variable Extraction 2 Duration = {0:2.4f} sec".format(duration))
 
             self.assertArrayEqual(expectedValue, actualValue)
 
+    def test_RadixCodec(self):
+
+        for size in [0, 1, 2, 3, 4, 1000, 1001]:
+            with self.subTest(key="{} Bytes".format(size)):
+                data = np.random.randint(0, 256, size).astype(np.uint8).tobytes()
+                symbols = encode6Bit(data)
+
+                self.assertEqual(base64.b64encode(data), sixBitToChars(symbols))
+                self.assertEqual(data, decode6Bit(symbols).tobytes())
+
+    def test_BinaryPayloadFormat(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        for level in [-1, 3, 9]:
+            with self.subTest(key="Level {}".format(level)):
+                p = Payload(img, level, version=2)
+                self.assertLess(len(p.content), len(Payload(img, level).content))
+
+                embedded = Carrier(carrierImg).embedPayload(p)
+                self.assertTrue(Carrier(embedded).payloadExists())
+
+                extracted = Carrier(embedded).extractPayload()
+                self.assertEqual(2, extracted.version)
+                self.assertArrayEqual(img, extracted.img)
+
+    def test_InPlaceEmbedding(self):
+
+        p = Payload(imread(join(self.folder, "payload3.png")), 3)
+        expectedValue = imread(join(self.folder, "result3_3.png"))
+
+        with self.subTest(key="Output Buffer"):
+            img = imread(join(self.folder, "carrier3.png"))
+            out = np.zeros_like(img)
+            actualValue = Carrier(img).embedPayload(p, out=out)
+
+            self.assertIs(out, actualValue)
+            self.assertArrayEqual(expectedValue, out)
+
+        with self.subTest(key="In Place"):
+            img = imread(join(self.folder, "carrier3.png"))
+            actualValue = Carrier(img).embedPayload(p, inplace=True)
+
+            self.assertIs(img, actualValue)
+            self.assertArrayEqual(expectedValue, img)
+
+    def test_MemoryMappedCarrier(self):
+
+        img = imread(join(self.folder, "carrier3.png"))
+        p = Payload(imread(join(self.folder, "payload3.png")), 3)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = join(folder, "carrier3.npy")
+            np.save(path, img)
+
+            c = Carrier.fromMemmap(path)
+            self.assertFalse(c.payloadExists())
+            c.embedPayload(p, inplace=True)
+
+            c = Carrier.fromMemmap(path, mode="r")
+            self.assertTrue(c.payloadExists())
+            self.assertArrayEqual(imread(join(self.folder, "result3_3.png")), np.array(c.img))
+            self.assertArrayEqual(imread(join(self.folder, "payload3.png")), c.extractPayload().img)
+            del c
+
+    def test_BatchEmbedding(self):
+
+        payloadImg = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+        pairs = [(payloadImg, carrierImg), (payloadImg[::-1], carrierImg), (payloadImg, carrierImg[::-1])]
+
+        expectedValues = [Carrier(c).embedPayload(Payload(p, 3)) for (p, c) in pairs]
+        actualValues = list(embedMany(pairs, workers=2, compressionLevel=3))
+
+        self.assertEqual(len(expectedValues), len(actualValues))
+        for (expectedValue, actualValue) in zip(expectedValues, actualValues):
+            self.assertArrayEqual(expectedValue, actualValue)
+
+    def test_BatchEmbeddingFailure(self):
+
+        payloadImg = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+        embeddedImg = imread(join(self.folder, "result3_3.png"))
+        pairs = [(payloadImg, carrierImg), (payloadImg, embeddedImg)] + [(payloadImg, carrierImg)] * 4
+
+        # The shared memory blocks of the jobs still in flight are released when one fails or iteration stops
+        shmFolder = "/dev/shm"
+        before = set(os.listdir(shmFolder)) if os.path.isdir(shmFolder) else set()
+
+        with self.assertRaises(Exception):
+            list(embedMany(pairs, workers=2))
+
+        batch = embedMany(pairs[2:], workers=2)
+        next(batch)
+        batch.close()
+
+        if os.path.isdir(shmFolder):
+            self.assertEqual(set(), set(os.listdir(shmFolder)) - before)
+
+    def test_FileHeaderProbe(self):
+
+        for name in ["carrier3.png", "result3_3.png", "result4_7.png", "result2_9.png", "carrier2.png"]:
+            with self.subTest(key=name):
+                path = join(self.folder, name)
+
+                self.assertEqual(Carrier(imread(path)).payloadExists(), payloadExistsInFile(path))
+
+        # Color carriers only need 7 pixels of their first row
+        narrowImg = np.ascontiguousarray(imread(join(self.folder, "carrier2.png"))[:, :7])
+        embedded = Carrier(narrowImg).embedPayload(Payload(imread(join(self.folder, "payload3.png"))[:8, :8], -1))
+
+        with tempfile.TemporaryDirectory() as folder:
+            imsave(join(folder, "embedded.png"), embedded)
+
+            self.assertEqual((7, 3), readLeadingPixels(join(folder, "embedded.png"), values=21).shape)
+            self.assertTrue(payloadExistsInFile(join(folder, "embedded.png")))
+
+    def test_PayloadCache(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = PayloadCache(folder=folder)
+            first = cache.get(img, 3)
+            second = cache.get(img, 3)
+
+            self.assertIs(first.content, second.content)
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+            diskCache = PayloadCache(folder=folder)
+            third = diskCache.get(img, 3)
+
+            self.assertEqual((0, 1, 0), (diskCache.hits, diskCache.diskHits, diskCache.misses))
+            self.assertArrayEqual(Payload(img, 3).content, third.content)
+
+    def test_CompressionSweep(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+
+        for version in [1, 2]:
+            sizes = contentSizes(img, version=version)
+
+            for level in range(-1, 10):
+                with self.subTest(key="Version {}, Level {}".format(version, level)):
+                    self.assertEqual(len(Payload(img, level, version=version).content), sizes[level])
+
+    def test_CompressionCodecs(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        for codec in ["zlib", "bz2", "lzma", "pzlib"]:
+            for version in [1, 2]:
+                with self.subTest(key="{}, Version {}".format(codec, version)):
+                    p = Payload(img, 9, version=version, codec=codec)
+                    extracted = Carrier(Carrier(carrierImg).embedPayload(p)).extractPayload()
+
+                    self.assertEqual(codec, extracted.codec)
+                    self.assertArrayEqual(img, extracted.img)
+
+    def test_StreamingEmbedding(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        for level in [-1, 3, 9]:
+            with self.subTest(key="Level {}".format(level)):
+                expectedValue = Carrier(carrierImg).embedPayload(Payload(img, level, version=2))
+                actualValue = Carrier(carrierImg).embedStream(img, level, chunkSize=4096)
+
+                self.assertArrayEqual(expectedValue, actualValue)
+
+        # A compressed body that turns out too large leaves an in-place carrier without a payload
+        carrier = Carrier(carrierImg.copy())
+        carrier.embedStream(img, 9, inplace=True)
+        noiseImg = np.random.RandomState(0).randint(0, 256, carrierImg.shape).astype(np.uint8)
+
+        self.assertRaises(ValueError, carrier.embedStream, noiseImg, 9, override=True, inplace=True, chunkSize=256)
+        self.assertFalse(carrier.payloadExists())
+
+    def test_BlockParallelDeflate(self):
+
+        data = imread(join(self.folder, "payload2.png")).tobytes()
+
+        for workers in [1, 2, 4]:
+            with self.subTest(key="{} Workers".format(workers)):
+                compressed = blockCompress(data, 9, blockSize=16384, workers=workers)
+
+                self.assertEqual(data, blockDecompress(compressed, workers=workers))
+                self.assertEqual(data, blockDecompress(compressed, workers=1))
+
+
+    def test_LsbDepth(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+        payload = Payload(img, 9, version=2)
+
+        for bitsPerChannel in [1, 2, 3, 4]:
+            with self.subTest(key="{} Bits".format(bitsPerChannel)):
+                embedded = Carrier(carrierImg).embedPayload(payload, bitsPerChannel=bitsPerChannel)
+                streamed = Carrier(carrierImg).embedStream(img, 9, chunkSize=4096, bitsPerChannel=bitsPerChannel)
+
+                self.assertArrayEqual(embedded, streamed)
+                changed = (embedded ^ carrierImg).reshape(-1)[HEADER_SAMPLES:]
+
+                self.assertEqual(0, np.count_nonzero(changed >> bitsPerChannel))
+                self.assertArrayEqual(img, Carrier(embedded).extractPayload().img)
+
+        with self.assertRaises(ValueError):
+            Carrier(carrierImg).embedPayload(Payload(img, 9), bitsPerChannel=1)
+
+
+    def test_CapacityPlanner(self):
+
+        img = imread(join(self.folder, "payload2.png"))
+        carrierImg = imread(join(self.folder, "carrier2.png"))
+
+        for version in [1, 2]:
+            with self.subTest(key="Version {}".format(version)):
+                csvBytes = csvLength(rasterScan(img)) if version == 1 else None
+                expectedValue = len(Payload(img, -1, version=version).content)
+                actualValue = symbolCount(plannedContentBytes(img.shape, img.dtype, version, csvBytes=csvBytes))
+
+                self.assertEqual(expectedValue, actualValue)
+
+        for bitsPerChannel in [1, 2, 3, 4]:
+            with self.subTest(key="{} Bits".format(bitsPerChannel)):
+                capacity = carrierCapacity(carrierImg.shape, bitsPerChannel)
+                body = np.zeros((1, capacity - PAYLOAD_HEADER.size), dtype=np.uint8)
+
+                Carrier(carrierImg).embedPayload(Payload(body, version=2), True, bitsPerChannel=bitsPerChannel)
+
+                with self.assertRaises(ValueError):
+                    body = np.zeros((1, body.size + 1), dtype=np.uint8)
+                    Carrier(carrierImg).embedPayload(Payload(body, version=2), True, bitsPerChannel=bitsPerChannel)
+
+
+    def test_ExtractToFile(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        for version in [1, 2]:
+            for compressionLevel in [-1, 6]:
+                with self.subTest(key="Version {} Level {}".format(version, compressionLevel)):
+                    payload = Payload(img, compressionLevel, version=version)
+                    embedded = Carrier(carrierImg).embedPayload(payload, override=True)
+
+                    with tempfile.TemporaryDirectory() as folder:
+                        shape = Carrier(embedded).extractTo(join(folder, "payload.png"), chunkSize=4096)
+
+                        self.assertEqual(img.shape, shape)
+                        self.assertArrayEqual(img, imread(join(folder, "payload.png")))
+
+
+    def test_BandEmbedding(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+        payload = Payload(img, 6, version=2)
+
+        for bandRows in [1, 16, 4096]:
+            with self.subTest(key="{} Rows".format(bandRows)):
+                with tempfile.TemporaryDirectory() as folder:
+                    imsave(join(folder, "carrier.png"), carrierImg)
+                    embedFile(payload, join(folder, "carrier.png"), join(folder, "embedded.png"), bandRows, True)
+
+                    expectedValue = Carrier(carrierImg).embedPayload(payload, override=True)
+                    actualValue = imread(join(folder, "embedded.png"))
+
+                    self.assertArrayEqual(expectedValue, actualValue)
+
+        # Nothing is written when the carrier already holds a payload
+        with tempfile.TemporaryDirectory() as folder:
+            self.assertRaises(Exception, embedFile, payload, join(self.folder, "result3_3.png"),
+                              join(folder, "embedded.png"))
+            self.assertEqual([], os.listdir(folder))
+
+
+    def test_Tracing(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        with Tracer() as tracer:
+            embedded = Carrier(carrierImg).embedPayload(Payload(img, 6), override=True)
+            Carrier(embedded).extractPayload()
+            Carrier(embedded).clean()
+
+        names = {name for (name, start, duration, size, thread) in tracer.spans}
+        expectedNames = {"Payload.generate", "compress", "formatCsvBody", "encode6Bit", "Carrier.embedPayload",
+                         "writeLsb", "Carrier.extractPayload", "locatePayload", "parseCsvBody", "inflate",
+                         "Carrier.clean"}
+
+        self.assertTrue(expectedNames <= names)
+        self.assertEqual(len(tracer.spans), len(tracer.chromeTrace()["traceEvents"]))
+        self.assertIn("Carrier.embedPayload", tracer.summary())
+
+        # Nothing is recorded once the tracer is closed
+        Payload(img, 6)
+        self.assertEqual(len(tracer.spans), len(tracer.chromeTrace()["traceEvents"]))
+        self.assertIs(span("compress"), span("encode6Bit"))
+
+
+    def test_SeededClean(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+        embedded = Carrier(carrierImg).embedPayload(Payload(img, 6, version=2), override=True)
+        carrier = Carrier(embedded)
+
+        # With a fixed seed and tile size, the result does not depend on the number of workers
+        expectedValue = carrier.clean(seed=7, chunkSize=4096, workers=1)
+        self.assertArrayEqual(expectedValue, carrier.clean(seed=7, chunkSize=4096, workers=4))
+        self.assertFalse(np.array_equal(expectedValue, carrier.clean(seed=8, chunkSize=4096)))
+        self.assertArrayEqual(embedded >> 2, expectedValue >> 2)
+
+        # Only the values holding the payload are randomized
+        stop = carrier.payloadRuns()[-1][1]
+        cleaned = carrier.clean(region="payload", seed=7).reshape(-1)
+        self.assertArrayEqual(embedded.reshape(-1)[stop:], cleaned[stop:])
+        self.assertArrayEqual(embedded, carrier.img)
+
+        self.assertEqual([], Carrier(carrierImg).payloadRuns())
+
+        # Non-contiguous carriers are cleaned in place too, without touching the values outside the view
+        buffer = embedded.copy()
+        view = buffer[:, ::2]
+        self.assertIs(view, Carrier(view).clean(inplace=True, seed=7))
+        self.assertArrayEqual(Carrier(embedded[:, ::2].copy()).clean(seed=7), view)
+        self.assertArrayEqual(embedded[:, 1::2], buffer[:, 1::2])
+        self.assertRaises(ValueError, carrier.clean, region="pixels")
+
+
+    def test_NarrowGrayCarrier(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        # Carriers narrower than the 21 values of the payload prefix are read across rows, as they are embedded
+        flat = carrierImg.reshape(-1)
+        narrowImg = flat[:flat.size // 9 * 9].reshape(-1, 9)
+        self.assertFalse(Carrier(narrowImg).payloadExists())
+        self.assertFalse(Carrier(narrowImg[:2]).payloadExists())
+        self.assertFalse(Carrier(narrowImg[:0]).payloadExists())
+
+        for version in [1, 2]:
+            with self.subTest(key="Version {}".format(version)):
+                embedded = Carrier(narrowImg).embedPayload(Payload(img, 6, version=version), override=True)
+
+                self.assertTrue(Carrier(embedded).payloadExists())
+                self.assertArrayEqual(img, Carrier(embedded).extractPayload().img)
+
+
+    def test_CommandLine(self):
+
+        img = imread(join(self.folder, "payload3.png"))
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        with tempfile.TemporaryDirectory() as folder:
+            # Carriers with the same name in different folders
+            for name in ["a", "b"]:
+                os.makedirs(join(folder, "in", name))
+                imsave(join(folder, "in", name, "carrier.png"), carrierImg)
+
+            carriers = join(folder, "in", "**", "*.png")
+            self.assertEqual(0, main(["-j", "1", "embed", join(self.folder, "payload3.png"), carriers,
+                                      "-o", join(folder, "embedded")]))
+            self.assertEqual(0, main(["-j", "1", "scan", join(folder, "embedded", "**", "*.png")]))
+            self.assertEqual(0, main(["-j", "1", "extract", join(folder, "embedded", "**", "*.png"),
+                                      "-o", join(folder, "payloads")]))
+
+            for name in ["a", "b"]:
+                with self.subTest(key=name):
+                    embedded = imread(join(folder, "embedded", name, "carrier.png"))
+                    self.assertArrayEqual(Carrier(carrierImg).embedPayload(Payload(img, -1)), embedded)
+                    self.assertArrayEqual(img, imread(join(folder, "payloads", name, "carrier_payload.png")))
+
+            # PNG layouts that cannot be streamed in bands are decoded whole
+            rgbaImg = np.dstack([carrierImg, carrierImg, carrierImg, carrierImg])
+            imsave(join(folder, "rgba.png"), rgbaImg)
+            self.assertEqual(0, main(["-j", "1", "embed", join(self.folder, "payload3.png"), join(folder, "rgba.png"),
+                                      "-o", join(folder, "banded"), "--bands", "16"]))
+            self.assertTrue(Carrier(imread(join(folder, "banded", "rgba.png"))).payloadExists())
+
+            # Directories are searched with their subfolders
+            self.assertEqual(0, main(["-j", "1", "clean", join(folder, "embedded"), "--seed", "1"]))
+            for name in ["a", "b"]:
+                self.assertFalse(Carrier(imread(join(folder, "embedded", name, "carrier.png"))).payloadExists())
+
+            # Finding nothing is an error
+            with self.assertRaises(SystemExit):
+                main(["-j", "1", "scan", join(folder, "missing", "*.png")])
+
+            # Inputs that would write the same output are refused
+            imsave(join(folder, "in", "a", "carrier.bmp"), carrierImg)
+            with self.assertRaises(SystemExit):
+                main(["-j", "1", "embed", join(self.folder, "payload3.png"), join(folder, "in", "a"),
+                      "-o", join(folder, "embedded")])
+
+
+    def test_RgbaPayload(self):
+
+        img = imread(join(self.folder, "payload4.png"))
+        rgbaImg = np.dstack([img[:, :, :3], np.full(img.shape[:2], 255, dtype=np.uint8)])
+        carrierImg = imread(join(self.folder, "carrier3.png"))
+
+        # XML payloads drop the alpha channel
+        for compressionLevel in [-1, 7]:
+            with self.subTest(key="Level {}".format(compressionLevel)):
+                payload = Payload(rgbaImg, compressionLevel)
+                embedded = Carrier(carrierImg).embedPayload(payload, override=True)
+
+                self.assertArrayEqual(img[:, :, :3], Carrier(embedded).extractPayload().img)
+                self.assertEqual(len(payload.content), contentSizes(rgbaImg, [compressionLevel])[compressionLevel])
+
+
+    @unittest.skipIf(SteganographyPreview is None, "PySide is not installed")
+    def test_PreviewAlpha(self):
+
+        img = imread(join(self.folder, "payload4.png"))[:, :, :3]
+        grayImg = imread(join(self.folder, "payload3.png"))
+        alpha = np.full(img.shape[:2], 255, dtype=np.uint8)
+
+        # Alpha channels are dropped before the pixels reach Qt
+        self.assertArrayEqual(img, SteganographyPreview.displayable(np.dstack([img, alpha])))
+        self.assertArrayEqual(grayImg, SteganographyPreview.displayable(np.dstack([grayImg, grayImg])))
+
+        image = SteganographyPreview.toQImage(np.dstack([grayImg, grayImg]))
+        self.assertEqual((grayImg.shape[1], grayImg.shape[0]), (image.width(), image.height()))
+        self.assertEqual(grayImg.shape[1], image.bytesPerLine())
+
+    @unittest.skipIf(SteganographyPreview is None, "PySide is not installed")
+    def test_PreviewPalette(self):
+
+        img = imread(join(self.folder, "payload4.png"))[:, :, :3]
+
+        # Palette images are previewed (and sized) with their colors, not their palette indices
+        with tempfile.TemporaryDirectory() as folder:
+            path = join(folder, "palette.png")
+            Image.fromarray(img).convert("P", palette=Image.ADAPTIVE).save(path)
+
+            with Image.open(path) as paletteImg:
+                expectedValue = np.array(paletteImg.convert("RGB"))
+
+            image = SteganographyPreview.LazyImage(path)
+            self.assertEqual(img.shape, image.shape)
+            self.assertArrayEqual(expectedValue, image.preview())
+
 
 if __name__ == '__main__':
     unittest.main(warnings='ignore')
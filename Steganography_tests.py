@@ -155,9 +155,9 @@ class SteganographyTestSuite(unittest.TestCase, ImageAssertion):
             img = imread(join(self.folder, "carrier2.png"))
             c = Carrier(img)
 
-            begin = time.clock()
+            begin = time.perf_counter()
             actualValue = c.payloadExists()
-            end = time.clock()
+            end = time.perf_counter()
 
             duration = end - begin
 
@@ -166,9 +166,9 @@ class SteganographyTestSuite(unittest.TestCase, ImageAssertion):
         with self.subTest(key="Payload Present"):
             img = imread(join(self.folder, "result1_9.png"))
             c = Carrier(img)
-            begin = time.clock()
+            begin = time.perf_counter()
             actualValue = c.payloadExists()
-            end = time.clock()
+            end = time.perf_counter()
 
             duration = end - begin
 